@@ -16,17 +16,24 @@
 #You should have received a copy of the GNU Lesser General Public License
 #along with migopy.  If not, see <http://www.gnu.org/licenses/>.
 
+import collections
 import datetime
-import importlib
+import json
 import logging
+import numbers
 import os
-import pymongo
 import re
+import socket
 import sys
+import threading
+import time
+import traceback
+import types
 
 from contextlib import contextmanager
-from fabric.api import local
-from fabric.colors import white
+
+# pymongo, fabric, multiprocessing and profiling modules are imported only
+# by code which uses them, so tasks like help start without loading them
 
 
 class MigopyException(Exception):
@@ -53,11 +60,103 @@ class Str(str):
         return Str(color_value + self + self.END)
 
 
+MANIFEST_VERSION = 2
+MIGRATION_MODULE_PREFIX = 'migopy_migration_'
+
+
 @contextmanager
 def cwd_in_syspath():
-    sys.path.insert(0, os.getcwd())
-    yield
-    sys.path.pop(0)
+    """Puts current working directory at the beginning of sys.path for the
+    time of with block"""
+    path = os.getcwd()
+    sys.path.insert(0, path)
+    try:
+        yield
+    finally:
+        sys.path.remove(path)
+
+
+def load_migration(directory, migr):
+    """Loads module of given migration file directly from its path, with
+    bytecode cached by python. Modules of project (and of migrations
+    package) can be imported at module level of migration, like when
+    migrations were imported as package. Neither sys.path nor sys.modules keep anything after loading,
+    see unload_migration()."""
+    path = os.path.join(directory, migr)
+    name = MIGRATION_MODULE_PREFIX + re.sub('\W', '_',
+                                            re.sub('\.py$', '', path))
+    try:
+        from importlib.util import module_from_spec, spec_from_file_location
+    except ImportError:
+        import imp
+        try:
+            with cwd_in_syspath():
+                return imp.load_source(name, path)
+        finally:
+            sys.modules.pop(name, None)
+
+    spec = spec_from_file_location(name, path)
+    migr_mod = module_from_spec(spec)
+    # available while executed, like in regular import
+    sys.modules[name] = migr_mod
+    try:
+        with cwd_in_syspath():
+            spec.loader.exec_module(migr_mod)
+    finally:
+        sys.modules.pop(name, None)
+    return migr_mod
+
+
+def unload_migration(migr_mod):
+    """Releases globals of migration module loaded by load_migration(),
+    without waiting for garbage collector (functions of module and its
+    globals reference each other)"""
+    if isinstance(migr_mod, types.ModuleType) and \
+            migr_mod.__name__.startswith(MIGRATION_MODULE_PREFIX):
+        migr_mod.__dict__.clear()
+
+
+@contextmanager
+def loaded_migration(directory, migr):
+    """Loads migration module for the time of with block"""
+    migr_mod = load_migration(directory, migr)
+    try:
+        yield migr_mod
+    finally:
+        unload_migration(migr_mod)
+
+
+def local(command):
+    """Runs shell command, with output passed through. Returns True when
+    command succeeded. Unlike fabric's local(), failure doesn't abort by
+    SystemExit, which would stop worker of thread pool without result."""
+    import subprocess
+    return subprocess.call(command, shell=True) == 0
+
+
+def run_commands(commands, workers):
+    """Runs shell commands by local(), at most given number of them at once.
+    Returns commands which failed."""
+    pool = thread_pool(min(workers, len(commands)))
+    try:
+        succeeded = pool.map(local, commands)
+    finally:
+        pool.close()
+        pool.join()
+    return [command for command, ok in zip(commands, succeeded) if not ok]
+
+
+def connect(client_class, *args):
+    """Creates mongo client of given class, pymongo.MongoClient when
+    class is None"""
+    if client_class is None:
+        from pymongo import MongoClient as client_class
+    return client_class(*args)
+
+
+def thread_pool(workers):
+    from multiprocessing.pool import ThreadPool
+    return ThreadPool(workers)
 
 
 def task(method=None, default=False):
@@ -80,6 +179,26 @@ def task(method=None, default=False):
         return wrapper
 
 
+def is_task(attr):
+    """Checks if attribute is marked as migopy task. Mocks and pymongo
+    objects return anything for missing attributes, so value is compared."""
+    migopy_task = getattr(attr, 'migopy_task', None)
+    return migopy_task is True or migopy_task == 'default'
+
+
+class TasksRegistry(type):
+    """Metaclass of migrations managers, which collects names of migopy tasks
+    once, when class is defined. Names of base class tasks are kept, so
+    tasks can be overridden by attributes marked later."""
+    def __init__(cls, name, bases, attrs):
+        super(TasksRegistry, cls).__init__(name, bases, attrs)
+        names = set(attr_name for attr_name, attr in attrs.items()
+                    if is_task(attr))
+        for base in bases:
+            names.update(getattr(base, 'migopy_tasks', ()))
+        cls.migopy_tasks = tuple(sorted(names))
+
+
 class ColorsLogger(object):
     "Logger adapter"
     def __init__(self):
@@ -92,6 +211,7 @@ class ColorsLogger(object):
         self._logger.addHandler(handler)
 
     def white(self, msg):
+        from fabric.colors import white
         self._logger.info(white(msg))
 
     def red(self, msg):
@@ -101,63 +221,958 @@ class ColorsLogger(object):
         self._logger.info(Str(msg).color(Str.GREEN))
 
     def white_bold(self, msg):
+        from fabric.colors import white
         self._logger.info(white(msg, bold=True))
 
+    def plain(self, msg):
+        self._logger.info(msg)
+
+
+def cpu_time():
+    """Returns CPU time of current thread, when it's available, or of the
+    whole process otherwise"""
+    if hasattr(time, 'thread_time'):
+        return time.thread_time()
+    return sum(os.times()[:2])
+
+
+def format_record(label, record):
+    """Formats record of migration execution for logging"""
+    line = '%s: %.1fs (CPU %.1fs)' % (label, record['wall_time'],
+                                     record['cpu_time'])
+    if 'docs' in record:
+        line += ', %d documents, %.0f documents/s' % (
+            record['docs'], record['docs'] / max(record['wall_time'], 1e-6))
+    return line + ', on %s at %s' % (record['host'], record['finished'])
+
+
+def declared(migr_mod, name, default=None):
+    """Returns attribute declared in migration module. Only attributes
+    really declared are taken into account (not dynamic ones, like
+    attributes of mocks)."""
+    return vars(migr_mod).get(name, default)
+
+
+def accepts(func, count):
+    """Checks if python function can be called with given number of
+    positional arguments"""
+    import inspect
+    if hasattr(inspect, 'getfullargspec'):
+        spec = inspect.getfullargspec(func)
+    else:
+        spec = inspect.getargspec(func)
+    required = len(spec.args) - len(spec.defaults or ())
+    return required <= count and (count <= len(spec.args) or
+                                  spec.varargs is not None)
+
+
+def is_coroutine_function(func):
+    """Checks if function is coroutine function (async def), always False
+    on python without asyncio"""
+    import inspect
+    iscoroutinefunction = getattr(inspect, 'iscoroutinefunction', None)
+    return iscoroutinefunction is not None and iscoroutinefunction(func)
+
+
+def migration_collections(migr_mod):
+    """Returns list of collections declared by migration module or None,
+    when migration doesn't declare them"""
+    if declared(migr_mod, 'COLLECTIONS') is not None:
+        return list(declared(migr_mod, 'COLLECTIONS'))
+    if declared(migr_mod, 'COLLECTION') is not None:
+        return [declared(migr_mod, 'COLLECTION')]
+    collections = set()
+    for name in ('PIPELINE', 'INDEXES'):
+        collections.update(declared(migr_mod, name) or {})
+    if collections and declared(migr_mod, 'up') is None:
+        return sorted(collections)
+    return None
+
+
+# stages which can be used in pipeline of update command
+UPDATE_PIPELINE_STAGES = ('$addFields', '$set', '$project', '$unset',
+                          '$replaceRoot', '$replaceWith')
+
+
+VERSION_NAME = 'migopy:version'
+
+
+def bump_version(collection):
+    """Increments version of registrations kept in migrations collection,
+    which invalidates local caches of registrations"""
+    collection.update_one({'name': VERSION_NAME}, {'$inc': {'version': 1}},
+                          upsert=True)
+
+
+class Checkpoint(object):
+    """Checkpoint of resumable migration. Last processed key and number of
+    processed documents are kept in migration's document in migrations
+    collection, until migration is registered."""
+    def __init__(self, collection, name, value=None, processed=0):
+        self.collection = collection
+        self.name = name
+        self.value = value
+        self.processed = processed
+
+    def save(self, value, processed=None):
+        self.value = value
+        if processed is not None:
+            self.processed = processed
+        self.collection.update_one(
+            {'name': self.name},
+            {'$set': {'registered': False,
+                      'checkpoint': value,
+                      'processed': self.processed,
+                      'checkpoint_at': datetime.datetime.utcnow()}},
+            upsert=True)
+
+
+def format_duration(seconds):
+    seconds = int(seconds)
+    return '%d:%02d:%02d' % (seconds // 3600, seconds % 3600 // 60,
+                             seconds % 60)
+
+
+class Progress(object):
+    """Reports progress of migration: number of processed documents,
+    throughput, elapsed time and ETA (when total number of documents is
+    known). Updates are cheap, reports are logged at most every interval
+    seconds, as text or JSON lines (format 'json')."""
+    def __init__(self, name, logger, interval=5.0, format='text',
+                 clock=time.time, database=None):
+        self.name = name
+        self.database = database
+        self.logger = logger
+        self.interval = interval
+        self.format = format
+        self.clock = clock
+        self.started = self.reported_at = clock()
+        self.done = 0
+        self.total = None
+        self.updated = False
+
+    def update(self, done, total=None):
+        self.done = done
+        if total is not None:
+            self.total = total
+        self.updated = True
+        now = self.clock()
+        if now - self.reported_at >= self.interval:
+            self.report(now)
+
+    def finish(self):
+        """Reports final progress, when there was any update"""
+        if self.updated:
+            self.report(self.clock())
+
+    def report(self, now):
+        self.reported_at = now
+        elapsed = now - self.started
+        rate = self.done / elapsed if elapsed > 0 else 0.0
+        eta = None
+        if self.total is not None and rate > 0:
+            eta = max(self.total - self.done, 0) / rate
+
+        if self.format == 'json':
+            self.logger.plain(json.dumps(
+                {'migration': self.name,
+                 'database': self.database,
+                 'done': self.done,
+                 'total': self.total,
+                 'rate': round(rate, 1),
+                 'elapsed': round(elapsed, 1),
+                 'eta': round(eta, 1) if eta is not None else None},
+                sort_keys=True))
+            return None
+
+        message = '%s: %d' % (self.name, self.done)
+        if self.total:
+            message += ' of %d (%d%%)' % (self.total,
+                                          100 * self.done // self.total)
+        message += ' documents, %.1f docs/s, elapsed %s' % (
+            rate, format_duration(elapsed))
+        if eta is not None:
+            message += ', ETA %s' % format_duration(eta)
+        self.logger.white(message)
+
+
+_reporters = threading.local()
+
+
+def progress_reporter():
+    """Returns Progress of migration executed in current thread, if any"""
+    return getattr(_reporters, 'current', None)
+
+
+@contextmanager
+def reporting(reporter):
+    """Makes given Progress current in this thread, for the time of with
+    block, and reports final progress at the end"""
+    previous = progress_reporter()
+    _reporters.current = reporter
+    try:
+        yield reporter
+    finally:
+        _reporters.current = previous
+        reporter.finish()
+
+
+def progress(done, total=None):
+    """Reports number of documents processed by currently executed
+    migration (and their total number, when known), e.g.:
+
+        def up(db):
+            total = db.notes.count()
+            for i, note in enumerate(db.notes.find()):
+                ...
+                migopy.progress(i + 1, total)
+
+    Does nothing outside of executed migration."""
+    reporter = progress_reporter()
+    if reporter is not None:
+        reporter.update(done, total)
+
+
+class PrometheusTextfile(object):
+    """Metrics sink writing Prometheus text format file, to be collected by
+    node_exporter's textfile collector. Gauges keep the last recorded value,
+    histograms are cumulative over BUCKETS (in seconds). File is replaced
+    atomically on each flush."""
+    BUCKETS = (0.01, 0.05, 0.1, 0.5, 1, 5, 10)
+
+    def __init__(self, path):
+        self.path = path
+        self.gauges = {}
+        self.histograms = {}
+        self.lock = threading.Lock()
+
+    def record(self, name, value, labels=None, kind='gauge'):
+        key = (name, tuple(sorted((labels or {}).items())))
+        with self.lock:
+            if kind == 'histogram':
+                buckets, count, total = self.histograms.get(
+                    key, ([0] * len(self.BUCKETS), 0, 0.0))
+                buckets = [n + (value <= bound)
+                           for n, bound in zip(buckets, self.BUCKETS)]
+                self.histograms[key] = (buckets, count + 1, total + value)
+            else:
+                self.gauges[key] = value
+
+    def flush(self):
+        def format_labels(labels, extra=()):
+            labels = list(labels) + list(extra)
+            if not labels:
+                return ''
+            return '{%s}' % ','.join(
+                '%s="%s"' % (label, str(value).replace('\\', '\\\\')
+                             .replace('"', '\\"'))
+                for label, value in labels)
+
+        lines = []
+        with self.lock:
+            typed = set()
+            for (name, labels), value in sorted(self.gauges.items()):
+                if name not in typed:
+                    typed.add(name)
+                    lines.append('# TYPE %s gauge' % name)
+                lines.append('%s%s %s' % (name, format_labels(labels), value))
+            for (name, labels), (buckets, count, total) in \
+                    sorted(self.histograms.items()):
+                if name not in typed:
+                    typed.add(name)
+                    lines.append('# TYPE %s histogram' % name)
+                for bound, n in zip(self.BUCKETS, buckets):
+                    lines.append('%s_bucket%s %d' % (
+                        name, format_labels(labels, [('le', bound)]), n))
+                lines.append('%s_bucket%s %d' % (
+                    name, format_labels(labels, [('le', '+Inf')]), count))
+                lines.append('%s_count%s %d' % (name, format_labels(labels),
+                                                count))
+                lines.append('%s_sum%s %s' % (name, format_labels(labels),
+                                              total))
+
+        import tempfile
+        # own temporary file of each flush, sink can be shared by threads
+        fd, tmp_path = tempfile.mkstemp(
+            prefix=os.path.basename(self.path),
+            dir=os.path.dirname(os.path.abspath(self.path)))
+        try:
+            with os.fdopen(fd, 'w') as f:
+                f.write('\n'.join(lines) + '\n')
+            # readable by exporter, like regular file
+            os.chmod(tmp_path, 0o644)
+            os.rename(tmp_path, self.path)
+        except Exception:
+            os.remove(tmp_path)
+            raise
+
+
+class JsonLinesMetrics(object):
+    """Metrics sink appending each recorded value to file as JSON line with
+    name, value, labels, kind and unix time"""
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+
+    def record(self, name, value, labels=None, kind='gauge'):
+        line = json.dumps({'name': name, 'value': value,
+                           'labels': labels or {}, 'kind': kind,
+                           'time': time.time()}, sort_keys=True)
+        with self.lock:
+            with open(self.path, 'a') as f:
+                f.write(line + '\n')
+
+    def flush(self):
+        pass
+
+
+@contextmanager
+def recording(metrics, labels):
+    """Makes given metrics sink (and labels) current in this thread, for the
+    time of with block, so batches written by helpers are observed"""
+    previous = getattr(_reporters, 'metrics', None)
+    _reporters.metrics = (metrics, labels) if metrics is not None else None
+    try:
+        yield metrics
+    finally:
+        _reporters.metrics = previous
+
+
+@contextmanager
+def throttling(options):
+    """Makes given options of Throttle (None when throttling is off)
+    current in this thread, for the time of with block, so rewrite() called
+    by migration is throttled by its migrations manager"""
+    previous = getattr(_reporters, 'throttle', None)
+    _reporters.throttle = options
+    try:
+        yield options
+    finally:
+        _reporters.throttle = previous
+
+
+def current_throttle(db, batch_size):
+    """Returns Throttle of migration executed in this thread, configured by
+    THROTTLE_* attributes of its migrations manager. None when throttling
+    is off or nothing is executed."""
+    options = getattr(_reporters, 'throttle', None)
+    if options is None:
+        return None
+    return Throttle(db, batch_size, **options)
 
-class MigrationsManager(object):
+
+@contextmanager
+def logging_to(logger):
+    """Makes given logger current in this thread, for the time of with
+    block, so rewrite() called by migration logs to its migrations manager
+    (e.g. with prefix of tenant database)"""
+    previous = getattr(_reporters, 'logger', None)
+    _reporters.logger = logger
+    try:
+        yield logger
+    finally:
+        _reporters.logger = previous
+
+
+def current_logger():
+    """Returns logger of migrations manager executing migration in this
+    thread, MigrationsManager.logger when nothing is executed"""
+    return getattr(_reporters, 'logger', None) or MigrationsManager.logger
+
+
+def forget_reporters():
+    """Initializer of processes forked by run_partitioned(). Drops progress
+    reporter and metrics sink copied from parent process, progress and
+    metrics of ranges are reported only by the parent."""
+    _reporters.current = None
+    _reporters.metrics = None
+
+
+class BatchLatencies(list):
+    """Metrics sink of processes rewriting ranges, which only collects
+    latencies of batches, to observe them in parent process"""
+    def record(self, name, value, labels=None, kind='gauge'):
+        self.append(value)
+
+    def flush(self):
+        pass
+
+
+def observe_batch(latency):
+    """Records latency of bulk write (in seconds) of currently executed
+    migration, in migopy_batch_latency_seconds histogram of its metrics
+    sink. Does nothing when there is no sink."""
+    current = getattr(_reporters, 'metrics', None)
+    if current is not None:
+        metrics, labels = current
+        metrics.record('migopy_batch_latency_seconds', latency, labels,
+                       'histogram')
+
+
+def estimated_count(collection):
+    """Returns number of documents in collection, taken from metadata"""
+    if hasattr(collection, 'estimated_document_count'):
+        return collection.estimated_document_count()
+    return collection.count()
+
+
+def replication_lag(db):
+    """Returns replication lag of the slowest secondary in seconds, zero
+    when mongo is not a replica set"""
+    import pymongo.errors
+    try:
+        status = db.client.admin.command('replSetGetStatus')
+    except pymongo.errors.OperationFailure:
+        return 0
+
+    optimes = dict((state, [member['optimeDate']
+                            for member in status['members']
+                            if member['stateStr'] == state])
+                   for state in ('PRIMARY', 'SECONDARY'))
+    if not optimes['PRIMARY'] or not optimes['SECONDARY']:
+        return 0
+    lag = optimes['PRIMARY'][0] - min(optimes['SECONDARY'])
+    return max(lag.total_seconds(), 0)
+
+
+class Throttle(object):
+    """Adapts size of write batches to the health of mongo cluster. Batch
+    size is halved when latency of the batch or replication lag exceeds
+    limits and grows back when cluster is healthy. Writes are paused as
+    long as replication lag is too big. Lag is checked by lag_func (by
+    default replSetGetStatus command) at most every check_interval
+    seconds."""
+    def __init__(self, db, batch_size=1000, min_batch_size=10, max_lag=10,
+                 max_latency=1.0, pause=1.0, check_interval=5.0,
+                 lag_func=None, sleep=time.sleep):
+        self.batch_size = self.max_batch_size = batch_size
+        self.min_batch_size = min(min_batch_size, batch_size)
+        self.max_lag = max_lag
+        self.max_latency = max_latency
+        self.pause = pause
+        self.check_interval = check_interval
+        self.lag_func = lag_func or (lambda: replication_lag(db))
+        self.sleep = sleep
+        self._lag = 0
+        self._checked_at = None
+
+    def lag(self, force=False):
+        now = time.time()
+        if force or self._checked_at is None or \
+                now - self._checked_at >= self.check_interval:
+            self._lag = self.lag_func()
+            self._checked_at = now
+        return self._lag
+
+    def shrink(self):
+        self.batch_size = max(self.batch_size // 2, self.min_batch_size)
+
+    def grow(self):
+        self.batch_size = min(self.batch_size * 3 // 2 + 1,
+                              self.max_batch_size)
+
+    def observe(self, latency):
+        """Adapts batch size after batch written in given latency (in
+        seconds). Waits while replication lag is too big."""
+        healthy = latency <= self.max_latency
+        if not healthy:
+            self.shrink()
+
+        lag = self.lag()
+        while lag > self.max_lag:
+            healthy = False
+            self.shrink()
+            self.sleep(self.pause)
+            lag = self.lag(force=True)
+
+        if healthy:
+            self.grow()
+
+
+class CreateIndex(object):
+    """Index creation yielded by generator migrations, like pymongo's
+    IndexModel (which is not available in pymongo 2.x), e.g.:
+
+        yield 'notes', migopy.CreateIndex([('title', 1)], unique=True)
+
+    Indexes are built in background by default, so builds don't block
+    database on mongo older than 4.2 (newer ones ignore the option).
+    """
+    def __init__(self, keys, **options):
+        if isinstance(keys, (str, type(u''))):
+            keys = [(keys, 1)]
+        self.keys = [tuple(key) for key in keys]
+        options.setdefault('background', True)
+        self.options = options
+
+    def name(self):
+        """Returns name of index, given or generated like by mongo"""
+        return self.options.get('name') or \
+            '_'.join('%s_%s' % key for key in self.keys)
+
+    def find_in(self, information):
+        """Returns name of index with the same spec in given result of
+        index_information(), None when there is no such index"""
+        options = dict((option, value) for option, value
+                       in self.options.items()
+                       if option not in ('name', 'background'))
+        for name, info in sorted(information.items()):
+            if [tuple(key) for key in info['key']] == self.keys and \
+                    all(info.get(option) == value
+                        for option, value in options.items()):
+                return name
+        return None
+
+    def create(self, collection):
+        collection.create_index(self.keys, **self.options)
+
+
+def index_spec(index):
+    """Returns CreateIndex of index declared in INDEXES of migration, as
+    CreateIndex or keys"""
+    if isinstance(index, CreateIndex):
+        return index
+    return CreateIndex(index)
+
+
+MigrationFile = collections.namedtuple('MigrationFile',
+                                       'number name path')
+
+
+class MigrationsManager(TasksRegistry('TasksRegistryBase', (object,), {})):
     MIGRATIONS_FILE_PATTERN = '(?P<migr_nr>[0-9]+)_[a-z0-9_]+\.py'
     MIGRATIONS_COLLECTION = 'migrations'
     MIGRATIONS_DIRECTORY = 'mongomigrations'
+    MIGRATIONS_MANIFEST = '.migopy_manifest'
+    MIGRATIONS_MANIFEST_RACY_SECONDS = 2
+    MIGRATIONS_WRITE_CONCERN = None
+    REGISTERED_QUERY_BATCH_SIZE = 1000
+    REGISTER_BATCH_SIZE = 500
+    REGISTRATIONS_CACHE = None
+    REGISTRATIONS_OFFLINE = False
+    EXECUTE_WORKERS = 1
+    ENVIRONMENT = 'current'
+    STATS_ENVIRONMENTS = {}
+    STATS_LIMIT = 10
+    THROTTLE = False
+    THROTTLE_MIN_BATCH_SIZE = 10
+    THROTTLE_MAX_LAG = 10
+    THROTTLE_MAX_LATENCY = 1.0
+    THROTTLE_PAUSE = 1.0
+    THROTTLE_CHECK_INTERVAL = 5.0
+    PARALLEL_WORKERS = None
+    PARALLEL_RANGES_PER_WORKER = 4
+    PARALLEL_SAMPLES = 20
+    PARALLEL_BATCH_SIZE = 1000
+    GENERATOR_BATCH_SIZE = 1000
+    INDEX_BUILD_WORKERS = 4
+    INDEX_POLL_INTERVAL = 5.0
+    PROGRESS_INTERVAL = 5.0
+    PROGRESS_FORMAT = 'text'
+    METRICS = None
+    REGRESSION_RUNS = 5
+    REGRESSION_FACTOR = 1.5
     MONGO_HOST = 'localhost'
     MONGO_PORT = 27017
     MONGO_DATABASE = None
+    MONGO_DATABASES = None
+    FAN_OUT_WORKERS = 8
+    REMOTE_WORKERS = 4
+    REMOTE_DIRECTORY = None
     MONGO_USER = None
     MONGO_USER_PASS = None
     MONGO_DUMP_DIRECTORY = 'mongodumps'
     DO_MONGO_DUMP = False
+    MONGO_RESTORE_PARALLEL_COLLECTIONS = 4
+    MONGO_RESTORE_INSERTION_WORKERS = 4
+    DO_MONGO_SNAPSHOT = False
+    MONGO_SNAPSHOT_PREFIX = 'migopy_snapshot'
+    MONGO_SNAPSHOT_KEEP = 3
+    MONGO_DUMP_SELECTIVE = True
+    MONGO_DUMP_WORKERS = 4
+    MONGO_DUMP_GZIP = False
+    MONGO_DUMP_ARCHIVE = False
+    PROFILE_DIRECTORY = 'mongoprofiles'
+    PROFILE_SORT = 'tottime'
+    PROFILE_TOP = 20
+    PROFILE_REGISTER = False
+    CHECK_WORKERS = 8
     logger = ColorsLogger()
-    MongoClient = pymongo.MongoClient
+    MongoClient = None  # pymongo.MongoClient
+    AsyncMongoClient = None  # motor.motor_asyncio.AsyncIOMotorClient
+    _compiled_patterns = {}
 
     def __init__(self):
-        self.db = None
-        self.collection = None
-        if self.MONGO_DATABASE:
-            self.mongo_client = self.MongoClient(self.MONGO_HOST,
-                                                 self.MONGO_PORT)
-            self.db = self.mongo_client[self.MONGO_DATABASE]
+        self._mongo_client = None
+        self._db = None
+        self._collection = None
+        self._index_ensured = False
+        self._validated = set()
+
+    @property
+    def mongo_client(self):
+        """Mongo client, connected when used first time"""
+        if self._mongo_client is None and (self.MONGO_DATABASE or
+                                           self.MONGO_DATABASES):
+            self._mongo_client = connect(self.MongoClient, self.MONGO_HOST,
+                                         self.MONGO_PORT)
+        return self._mongo_client
+
+    @mongo_client.setter
+    def mongo_client(self, value):
+        self._mongo_client = value
+
+    @property
+    def db(self):
+        """Migrated database, authenticated when used first time"""
+        if self._db is None and self.MONGO_DATABASE:
+            self._db = self.mongo_client[self.MONGO_DATABASE]
             if self.MONGO_USER and self.MONGO_USER_PASS:
-                self.db.authenticate(self.MONGO_USER, self.MONGO_USER_PASS)
-            self.collection = self.db[self.MIGRATIONS_COLLECTION]
+                self._db.authenticate(self.MONGO_USER, self.MONGO_USER_PASS)
+        return self._db
 
-    def sorted(self, migr_files):
-        exc_msg = "Founded incorrect name of migration file: %s\n" + \
-                  "Script aborted. Required pattern: " + \
-                  self.MIGRATIONS_FILE_PATTERN
+    @db.setter
+    def db(self, value):
+        self._db = value
+
+    @property
+    def collection(self):
+        """Collection of registered migrations"""
+        if self._collection is None and self.db is not None:
+            self._collection = self.db[self.MIGRATIONS_COLLECTION]
+        return self._collection
 
+    @collection.setter
+    def collection(self, value):
+        self._collection = value
+
+    def databases(self):
+        """Returns names of databases given by MONGO_DATABASES, which can be
+        a list or a method returning it"""
+        databases = self.MONGO_DATABASES
+        if callable(databases):
+            databases = databases()
+        return list(databases or [])
+
+    def tenant(self, database):
+        """Returns migrations manager of given database, sharing connection
+        and validated migrations with this one. Its messages are prefixed
+        with name of the database, its dumps and profiles are kept in own
+        subdirectories."""
+        tenant = type(self)()
+        tenant.MONGO_DATABASE = database
+        tenant.MONGO_DATABASES = None
+        if self.REGISTRATIONS_CACHE:
+            tenant.REGISTRATIONS_CACHE = '%s.%s' % (self.REGISTRATIONS_CACHE,
+                                                    database)
+        tenant.MONGO_DUMP_DIRECTORY = os.path.join(self.MONGO_DUMP_DIRECTORY,
+                                                   database)
+        tenant.PROFILE_DIRECTORY = os.path.join(self.PROFILE_DIRECTORY,
+                                                database)
+        tenant.logger = PrefixedLogger(self.logger, '[%s] ' % database)
+        tenant.mongo_client = self.mongo_client
+        tenant._validated = self._validated
+        return tenant
+
+    def fan_out(self, task_name, *args):
+        """Runs task of given name against every database of
+        MONGO_DATABASES, in pool of FAN_OUT_WORKERS threads, and shows
+        summary of results"""
+        databases = self.databases()
+
+        def run(database):
+            try:
+                getattr(self.tenant(database), task_name)(*args)
+                return database, None
+            except MigopyException as e:
+                return database, str(e)
+            except Exception:
+                return database, traceback.format_exc()
+            except SystemExit as e:
+                # fabric's abort(), it would stop worker without result
+                return database, 'aborted (exit code %s)' % e.code
+
+        pool = thread_pool(min(self.FAN_OUT_WORKERS, len(databases)) or 1)
+        try:
+            results = pool.map(run, databases)
+        finally:
+            pool.close()
+            pool.join()
+
+        self.logger.white_bold('Summary of %d databases:' % len(databases))
+        for database, error in results:
+            if error:
+                self.logger.red('%s - failed: %s' % (database, error))
+            else:
+                self.logger.green('%s - done' % database)
+        failed = [database for database, error in results if error]
+        if failed:
+            raise MigopyException('Failed in %d of %d databases: %s' %
+                                  (len(failed), len(databases),
+                                   ', '.join(failed)))
+
+    def pattern(self):
+        """Returns compiled MIGRATIONS_FILE_PATTERN, compiled only once"""
+        pattern = self._compiled_patterns.get(self.MIGRATIONS_FILE_PATTERN)
+        if pattern is None:
+            pattern = re.compile(self.MIGRATIONS_FILE_PATTERN)
+            self._compiled_patterns[self.MIGRATIONS_FILE_PATTERN] = pattern
+        return pattern
+
+    def migration_file(self, filename):
+        """Parses name of migration file into MigrationFile record. Number
+        of migration is None when name doesn't fulfill the pattern."""
+        match = self.pattern().match(filename)
+        number = int(match.group('migr_nr')) if match else None
+        path = os.path.join(self.MIGRATIONS_DIRECTORY, filename)
+        return MigrationFile(number, filename, path)
+
+    def sorted_files(self, migr_files):
+        """Sorts MigrationFile records by migration number"""
+        for migr_file in migr_files:
+            if migr_file.number is None:
+                raise MigopyException(
+                    ("Founded incorrect name of migration file: %s\n" +
+                     "Script aborted. Required pattern: %s") %
+                    (migr_file.name, self.MIGRATIONS_FILE_PATTERN))
+
+        return sorted(migr_files, key=lambda m: (m.number, m.name))
+
+    def sorted(self, migr_files):
         if '__init__.py' in migr_files:
             migr_files.remove('__init__.py')
 
-        if len(migr_files) == 1:
-            match1 = re.match(self.MIGRATIONS_FILE_PATTERN, migr_files[0])
-            if not match1:
-                raise MigopyException(exc_msg % migr_files[0])
+        migr_files = [self.migration_file(fname) for fname in migr_files]
+        return [migr_file.name for migr_file in self.sorted_files(migr_files)]
 
-            return migr_files
+    def migrations_index(self):
+        """Returns MigrationFile records of all files in migrations directory,
+        sorted by migration number (files with incorrect names at the end).
+        Index is kept in MIGRATIONS_MANIFEST file and rebuilt only when
+        modification time of migrations directory changes."""
+        dir_mtime = os.stat(self.MIGRATIONS_DIRECTORY).st_mtime
+        manifest = self.read_manifest()
+        if manifest and manifest['mtime'] == dir_mtime:
+            return [MigrationFile(*row) for row in manifest['files']]
 
-        def sort_func(fname1, fname2):
-            match1 = re.match(self.MIGRATIONS_FILE_PATTERN, fname1)
-            match2 = re.match(self.MIGRATIONS_FILE_PATTERN, fname2)
+        index = []
+        for fname in os.listdir(self.MIGRATIONS_DIRECTORY):
+            if not fname.endswith('.py') or fname == '__init__.py':
+                continue
+            index.append(self.migration_file(fname))
 
-            if not match1 or not match2:
-                raise MigopyException(exc_msg)
+        index.sort(key=lambda m: (m.number is None, m.number, m.name))
+        # directory modified in the same moment can be modified once again
+        # without mtime change, so such index is not trusted later
+        if time.time() - dir_mtime > self.MIGRATIONS_MANIFEST_RACY_SECONDS:
+            self.write_manifest(dir_mtime, index)
+        return index
 
-            m1_nr = int(match1.group('migr_nr'))
-            m2_nr = int(match2.group('migr_nr'))
-            return cmp(m1_nr, m2_nr)
+    def read_manifest(self):
+        if not self.MIGRATIONS_MANIFEST or \
+                not os.path.exists(self.MIGRATIONS_MANIFEST):
+            return None
 
-        return sorted(migr_files, sort_func)
+        try:
+            with open(self.MIGRATIONS_MANIFEST) as f:
+                manifest = json.load(f)
+        except (IOError, ValueError):
+            return None
 
-    def unregistered(self):
+        if manifest.get('version') != MANIFEST_VERSION or \
+                manifest.get('directory') != self.MIGRATIONS_DIRECTORY or \
+                manifest.get('pattern') != self.MIGRATIONS_FILE_PATTERN:
+            return None
+        return manifest
+
+    def write_manifest(self, dir_mtime, index):
+        """Writes manifest into temporary file renamed to MIGRATIONS_MANIFEST,
+        so concurrent readers and writers (e.g. of MONGO_DATABASES) never
+        see it partially written"""
+        import tempfile
+        if not self.MIGRATIONS_MANIFEST:
+            return None
+
+        manifest = {'version': MANIFEST_VERSION,
+                    'directory': self.MIGRATIONS_DIRECTORY,
+                    'pattern': self.MIGRATIONS_FILE_PATTERN,
+                    'mtime': dir_mtime,
+                    'files': [list(migr_file) for migr_file in index]}
+        tmp_path = None
+        try:
+            fd, tmp_path = tempfile.mkstemp(
+                prefix=os.path.basename(self.MIGRATIONS_MANIFEST),
+                dir=os.path.dirname(os.path.abspath(self.MIGRATIONS_MANIFEST)))
+            with os.fdopen(fd, 'w') as f:
+                json.dump(manifest, f)
+            os.rename(tmp_path, self.MIGRATIONS_MANIFEST)
+        except (IOError, OSError):
+            if tmp_path and os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def registrations(self, migr_files, offline=False):
+        """Returns documents of given migrations files from migrations
+        collection, as dict by name. Asks mongo only for given names, in
+        batches of REGISTERED_QUERY_BATCH_SIZE names per query, or takes
+        them from REGISTRATIONS_CACHE, when it's set."""
+        if self.REGISTRATIONS_CACHE:
+            cached = self.cached_registrations(offline)
+            return dict((name, cached[name]) for name in migr_files
+                        if name in cached)
+
+        registrations = {}
+        batch_size = self.REGISTERED_QUERY_BATCH_SIZE
+        for i in range(0, len(migr_files), batch_size):
+            batch = migr_files[i:i + batch_size]
+            cursor = self.collection.find({'name': {'$in': batch}},
+                                          {'_id': False})
+            registrations.update((row['name'], row) for row in cursor)
+        return registrations
+
+    def version(self):
+        """Returns version of registrations, incremented by every change"""
+        document = self.collection.find_one({'name': VERSION_NAME},
+                                            {'version': True})
+        return (document or {}).get('version', 0)
+
+    def cached_registrations(self, offline=False):
+        """Returns documents of all migrations from REGISTRATIONS_CACHE file.
+        Cache is refreshed when version of registrations in mongo differs
+        from the cached one. When offline, mongo is not asked at all."""
+        cache = self.read_cache()
+        if offline:
+            if cache is None:
+                raise MigopyException(("Registrations cache %s not " +
+                                       "founded, can not work offline") %
+                                      self.REGISTRATIONS_CACHE)
+            return cache['registrations']
+
+        version = self.version()
+        if cache is not None and cache['version'] == version:
+            return cache['registrations']
+
+        cursor = self.collection.find(
+            {'name': {'$not': re.compile('^migopy:')}}, {'_id': False})
+        registrations = dict((row['name'], row) for row in cursor)
+        self.write_cache(version, registrations)
+        return registrations
+
+    def read_cache(self):
+        from bson import json_util
+
+        def object_hook(dct):
+            # naive UTC datetimes, like the ones returned by pymongo
+            value = json_util.object_hook(dct)
+            if isinstance(value, datetime.datetime) and value.tzinfo:
+                value = value.replace(tzinfo=None)
+            return value
+
+        if not os.path.exists(self.REGISTRATIONS_CACHE):
+            return None
+
+        try:
+            with open(self.REGISTRATIONS_CACHE) as f:
+                cache = json.load(f, object_hook=object_hook)
+        except (IOError, ValueError):
+            return None
+
+        if cache.get('host') != self.MONGO_HOST or \
+                cache.get('port') != self.MONGO_PORT or \
+                cache.get('database') != self.MONGO_DATABASE or \
+                cache.get('collection') != self.MIGRATIONS_COLLECTION:
+            return None
+        return cache
+
+    def write_cache(self, version, registrations):
+        """Writes registrations into temporary file renamed to
+        REGISTRATIONS_CACHE, like write_manifest()"""
+        import tempfile
+        from bson import json_util
+        cache = {'host': self.MONGO_HOST,
+                 'port': self.MONGO_PORT,
+                 'database': self.MONGO_DATABASE,
+                 'collection': self.MIGRATIONS_COLLECTION,
+                 'version': version,
+                 'registrations': registrations}
+        tmp_path = None
+        try:
+            fd, tmp_path = tempfile.mkstemp(
+                prefix=os.path.basename(self.REGISTRATIONS_CACHE),
+                dir=os.path.dirname(os.path.abspath(self.REGISTRATIONS_CACHE)))
+            with os.fdopen(fd, 'w') as f:
+                json.dump(cache, f, default=json_util.default)
+            os.rename(tmp_path, self.REGISTRATIONS_CACHE)
+        except (IOError, OSError):
+            if tmp_path and os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def registered(self, migr_files):
+        """Returns set of given migrations files which are registered.
+        Partially applied migrations are not registered."""
+        return set(name for name, registration in
+                   self.registrations(migr_files).items()
+                   if registration.get('registered') is not False)
+
+    def ensure_index(self):
+        """Creates unique index on names of registered migrations, once per
+        migrations manager"""
+        if self._index_ensured:
+            return None
+
+        import pymongo.errors
+        try:
+            self.collection.create_index('name', unique=True)
+        except pymongo.errors.DuplicateKeyError:
+            raise MigopyException(("Collection %s contains duplicated " +
+                                   "migrations, remove them to continue") %
+                                  self.MIGRATIONS_COLLECTION)
+        self._index_ensured = True
+
+    def register(self, migr_files, fields=None):
+        """Registers given migrations with unordered bulk upserts of
+        REGISTER_BATCH_SIZE documents, replacing checkpoints of partially
+        applied migrations. Registering can be safely retried. Given fields
+        are saved in documents of all migrations."""
+        import pymongo
+        import pymongo.errors
+        from pymongo.write_concern import WriteConcern
+        self.ensure_index()
+        collection = self.collection
+        if self.MIGRATIONS_WRITE_CONCERN:
+            write_concern = WriteConcern(**self.MIGRATIONS_WRITE_CONCERN)
+            collection = collection.with_options(write_concern=write_concern)
+
+        batch_size = self.REGISTER_BATCH_SIZE
+        for i in range(0, len(migr_files), batch_size):
+            requests = [pymongo.ReplaceOne({'name': migr},
+                                           dict(fields or {}, name=migr),
+                                           upsert=True)
+                        for migr in migr_files[i:i + batch_size]]
+            try:
+                collection.bulk_write(requests, ordered=False)
+            except pymongo.errors.BulkWriteError as e:
+                # duplicated key errors means migrations registered in
+                # the meantime
+                if e.details.get('writeConcernErrors') or \
+                        any(error['code'] != 11000
+                            for error in e.details['writeErrors']):
+                    raise
+        bump_version(self.collection)
+
+    def checkpoint(self, migr):
+        """Returns checkpoint of given migration, empty when migration was
+        not partially applied"""
+        registration = self.collection.find_one({'name': migr}) or {}
+        if registration.get('registered') is not False:
+            registration = {}
+        return Checkpoint(self.collection, migr,
+                          registration.get('checkpoint'),
+                          registration.get('processed', 0))
+
+    def pending(self, offline=False):
+        """Returns sorted list of unregistered migrations as pairs of file
+        name and document from migrations collection (None when migration
+        was never executed)"""
         if not os.path.exists(self.MIGRATIONS_DIRECTORY):
             raise MigopyException("Migrations directory %s not founded" %
                                   self.MIGRATIONS_DIRECTORY)
@@ -167,27 +1182,193 @@ class MigrationsManager(object):
             with open(initpy_path, 'w'):
                 pass
 
-        migr_files = [fname for fname in os.listdir(self.MIGRATIONS_DIRECTORY)
-                      if re.search('\.py$', fname)]
-        migr_files = [filename for filename in migr_files if
-                      not self.collection.find_one({'name': filename})]
-        return self.sorted(migr_files)
+        index = self.migrations_index()
+        registrations = self.registrations([migr_file.name
+                                            for migr_file in index], offline)
+        migr_files = [migr_file for migr_file in index
+                      if migr_file.name not in registrations or
+                      registrations[migr_file.name].get('registered') is False]
+        self.metric('migopy_pending_migrations', len(migr_files))
+        return [(migr_file.name, registrations.get(migr_file.name))
+                for migr_file in self.sorted_files(migr_files)]
+
+    def unregistered(self):
+        return [migr for migr, registration in self.pending()]
+
+    def validate(self, migr):
+        """Returns list of problems found in given migration file, empty
+        when migration can be executed"""
+        import inspect
+        if self.migration_file(migr).number is None:
+            return ['incorrect name, required pattern: %s' %
+                    self.MIGRATIONS_FILE_PATTERN]
+        try:
+            migr_mod = load_migration(self.MIGRATIONS_DIRECTORY, migr)
+        except Exception:
+            error = traceback.format_exception_only(*sys.exc_info()[:2])
+            return ['can not be loaded: %s' % ''.join(error).strip()]
+
+        string_types = (str, type(u''))
+
+        def names(value):
+            return isinstance(value, (list, tuple)) and \
+                all(isinstance(name, string_types) for name in value)
+
+        def pipelines(value):
+            return isinstance(value, dict) and \
+                all(isinstance(name, string_types) and
+                    isinstance(stages, (list, tuple)) and
+                    all(isinstance(stage, dict) for stage in stages)
+                    for name, stages in value.items())
+
+        def indexes(value):
+            return isinstance(value, dict) and \
+                all(isinstance(name, string_types) and
+                    isinstance(specs, (list, tuple)) and
+                    all(isinstance(spec, (CreateIndex, string_types, list))
+                        for spec in specs)
+                    for name, specs in value.items())
+
+        def migration_names(value):
+            # .py suffix is optional, as in dependencies()
+            return names(value) and \
+                all(self.migration_file(
+                    name if name.endswith('.py') else name + '.py').number
+                    is not None for name in value)
+
+        problems = []
+        try:
+            if declared(migr_mod, 'COLLECTION') and \
+                    declared(migr_mod, 'transform'):
+                functions = [('transform', 1)]
+            elif declared(migr_mod, 'PIPELINE') is not None or \
+                    (declared(migr_mod, 'INDEXES') is not None and
+                     declared(migr_mod, 'up') is None):
+                functions = []
+            elif declared(migr_mod, 'RESUMABLE') is True:
+                functions = [('up', 2)]
+            else:
+                functions = [('up', 1)]
+            # indexes are dropped by rollback, so down() is needed only
+            # when there is something more to undo
+            if declared(migr_mod, 'DOWN_PIPELINE') is None and \
+                    (declared(migr_mod, 'INDEXES') is None or
+                     declared(migr_mod, 'up') is not None):
+                functions.append(('down', 1))
+            for name, count in functions:
+                func = getattr(migr_mod, name, None)
+                if not callable(func):
+                    problems.append('%s() function not found' % name)
+                # only real functions, not mocks or other callables
+                elif inspect.isfunction(func) and not accepts(func, count):
+                    problems.append('%s() should take %d argument%s' %
+                                    (name, count, 's' if count > 1 else ''))
+
+            metadata = [
+                ('COLLECTION', lambda v: isinstance(v, string_types),
+                 'name of collection'),
+                ('COLLECTIONS', names, 'list of collections names'),
+                ('DEPENDS_ON', migration_names,
+                 'list of migrations files names'),
+                ('RESUMABLE', lambda v: isinstance(v, bool), 'True or False'),
+                ('QUERY', lambda v: isinstance(v, dict), 'query document'),
+                ('PROJECTION', lambda v: isinstance(v, dict),
+                 'projection document'),
+                ('PIPELINE', pipelines, 'dict of pipelines by collection'),
+                ('DOWN_PIPELINE', pipelines,
+                 'dict of pipelines by collection'),
+                ('INDEXES', indexes, 'dict of indexes lists by collection')]
+            for name, valid, expected in metadata:
+                value = declared(migr_mod, name)
+                if value is not None and not valid(value):
+                    problems.append('%s should be %s' % (name, expected))
+
+            # pipelines are applied instead of functions
+            for pipeline, function in [('PIPELINE', 'up'),
+                                       ('DOWN_PIPELINE', 'down')]:
+                if declared(migr_mod, pipeline) is not None and \
+                        declared(migr_mod, function) is not None:
+                    problems.append('%s and %s() declared, %s() would be '
+                                    'ignored' % (pipeline, function, function))
+        finally:
+            unload_migration(migr_mod)
+        return problems
+
+    def preflight(self, migr_files):
+        """Validates given migrations concurrently, in pool of CHECK_WORKERS
+        threads, before any of them is executed. Problems are logged and
+        MigopyException is raised when any migration is invalid."""
+        migr_files = [migr for migr in migr_files
+                      if migr not in self._validated]
+        if not migr_files:
+            return None
+
+        pool = thread_pool(min(self.CHECK_WORKERS, len(migr_files)))
+        try:
+            problems = pool.map(self.validate, migr_files)
+        finally:
+            pool.close()
+            pool.join()
+
+        invalid = [(migr, migr_problems) for migr, migr_problems
+                   in zip(migr_files, problems) if migr_problems]
+        self._validated.update(migr for migr, migr_problems
+                               in zip(migr_files, problems)
+                               if not migr_problems)
+        for migr, migr_problems in invalid:
+            self.logger.red('%s - %s' % (migr, '; '.join(migr_problems)))
+        if invalid:
+            raise MigopyException('Invalid migrations: %s' %
+                                  ', '.join(migr for migr, _ in invalid))
+
+    @task
+    def check(self, spec_migr=None):
+        """Validate pending migrations without executing them"""
+        if self.MONGO_DATABASES:
+            return self.fan_out('check', spec_migr)
+
+        unreg_migr = self.unregistered()
+        if spec_migr and spec_migr not in unreg_migr:
+            raise MigopyException(('Migration %s is not on unregistred ' +
+                                   'migrations list. Can not be checked') %
+                                  spec_migr)
+
+        if spec_migr:
+            unreg_migr = [spec_migr]
+
+        self.preflight(unreg_migr)
+        self.logger.green('Pending migrations are valid (%d checked)' %
+                          len(unreg_migr))
 
     @task(default=True)
     def show_status(self):
         """Show status of unregistered migrations (default)"""
-        unreg_migr = self.unregistered()
+        if self.MONGO_DATABASES:
+            return self.fan_out('show_status')
+
+        unreg_migr = self.pending(self.REGISTRATIONS_OFFLINE)
         if unreg_migr:
             self.logger.white_bold('Unregistered migrations ' +
                                    '(fab migrations:execute to execute them):')
-            for migr in unreg_migr:
-                self.logger.red(migr)
+            for migr, registration in unreg_migr:
+                if registration and 'checkpoint' in registration:
+                    self.logger.red(
+                        ('%s - partially applied, %d documents processed ' +
+                         '(last: %s, %s)') %
+                        (migr, registration.get('processed', 0),
+                         registration['checkpoint'],
+                         registration.get('checkpoint_at')))
+                else:
+                    self.logger.red(migr)
         else:
             self.logger.green('All migrations registered, nothing to execute')
 
     @task
     def execute(self, spec_migr=None):
         """Executes migrations"""
+        if self.MONGO_DATABASES:
+            return self.fan_out('execute', spec_migr)
+
         unreg_migr = self.unregistered()
         if not unreg_migr:
             self.show_status()
@@ -201,21 +1382,590 @@ class MigrationsManager(object):
         if spec_migr:
             unreg_migr = [spec_migr]
 
+        self.preflight(unreg_migr)
+        started = time.time()
+        dump = None
         if self.DO_MONGO_DUMP:
-            self.dbdump()
+            dump = self.dbdump(spec_migr)
 
-        with cwd_in_syspath():
-            for migr in unreg_migr:
-                self.logger.white_bold('Executing migration %s...' % migr)
-                migr_name = re.sub('\.py$', '', migr)
-                module_name = '%s.%s' % (self.MIGRATIONS_DIRECTORY, migr_name)
-                migr_mod = importlib.import_module(module_name)
-                migr_mod.up(self.db)
-                self.collection.insert({'name': migr})
+        executed = []
+        try:
+            if self.EXECUTE_WORKERS > 1 and len(unreg_migr) > 1:
+                self.run_scheduled(unreg_migr, executed)
+            else:
+                for migr in unreg_migr:
+                    self.logger.white_bold('Executing migration %s...' % migr)
+                    with loaded_migration(self.MIGRATIONS_DIRECTORY,
+                                          migr) as migr_mod:
+                        record = self.execute_migration(migr, migr_mod)
+                    self.register([migr], {'execute': record})
+                    executed.append((migr, record))
+        except Exception:
+            self.save_failed_run(started, executed, dump, len(unreg_migr))
+            raise
+        self.save_run(started, executed, dump, len(unreg_migr), False)
+
+    def execute_migration(self, migr, migr_mod):
+        """Executes single migration, with snapshot of its collections when
+        DO_MONGO_SNAPSHOT is set. Returns record of the execution."""
+        if self.DO_MONGO_SNAPSHOT:
+            self.snapshot(migr, migr_mod)
+        labels = {'database': self.MONGO_DATABASE or '', 'migration': migr}
+        created = []
+        with reporting(self.migration_progress(migr)), \
+                recording(self.METRICS, labels):
+            result, record = self.measure(self.run_up, migr, migr_mod,
+                                          created)
+        if created:
+            record['indexes'] = created
+        self.metric('migopy_migration_duration_seconds', record['wall_time'],
+                    migration=migr)
+        if 'docs' in record:
+            self.metric('migopy_migration_documents', record['docs'],
+                        migration=migr)
+        return record
+
+    def metric(self, name, value, **labels):
+        """Records gauge with given labels (and name of database) in METRICS
+        sink, if it's set"""
+        if self.METRICS is None:
+            return None
+        labels['database'] = self.MONGO_DATABASE or ''
+        self.METRICS.record(name, value, labels)
+        self.METRICS.flush()
+
+    def save_run(self, started, executed, dump, pending, failed):
+        """Stores summary of execute run (executed migrations given as pairs
+        of name and record) as 'migopy:run:<time>' document, with
+        regressions found against REGRESSION_RUNS previous successful runs.
+        Returns the summary."""
+        import pymongo
+        migrations = [{'name': migr,
+                       'wall_time': record['wall_time'],
+                       'docs': record.get('docs')}
+                      for migr, record in executed]
+        docs = sum(migration['docs'] or 0 for migration in migrations)
+        busy = sum(migration['wall_time'] for migration in migrations
+                   if migration['docs'])
+        stamp = re.sub('[:\.\s]', '_', str(datetime.datetime.now()))
+        run = {'name': 'migopy:run:%s' % stamp,
+               'created': datetime.datetime.utcnow(),
+               'duration': time.time() - started,
+               'migrations': migrations,
+               'docs': docs,
+               'throughput': docs / busy if busy else None,
+               'dump_duration': dump['duration'] if dump else None,
+               'pending': pending,
+               'failed': failed}
+        previous = list(self.collection.find(
+            {'name': {'$regex': '^migopy:run:'}, 'failed': False},
+            sort=[('created', pymongo.DESCENDING)],
+            limit=self.REGRESSION_RUNS))
+        run['regressions'] = self.regressions(run, previous)
+        self.collection.insert_one(run)
+        for regression in run['regressions']:
+            self.logger.red('Regression: %s' % regression)
+        self.metric('migopy_run_duration_seconds', run['duration'])
+        self.metric('migopy_run_regressions', len(run['regressions']))
+        return run
+
+    def save_failed_run(self, started, executed, dump, pending):
+        """Saves summary of failed run, see save_run(). Errors of saving
+        (e.g. of metrics sink) are only logged, so they don't hide
+        exception of the migration."""
+        try:
+            self.save_run(started, executed, dump, pending, True)
+        except Exception:
+            self.logger.red('Summary of run not saved:\n%s' %
+                            traceback.format_exc())
+
+    def regressions(self, run, previous):
+        """Returns descriptions of regressions of run summary against
+        previous runs: throughput, duration of mongo dump or wall time of
+        the same migration worse more than REGRESSION_FACTOR times than
+        their average in previous runs"""
+        def average(values):
+            values = [value for value in values if value]
+            return sum(values) / len(values) if values else None
+
+        factor = self.REGRESSION_FACTOR
+        found = []
+        throughput = average(prev.get('throughput') for prev in previous)
+        if throughput and run['throughput'] and \
+                run['throughput'] * factor < throughput:
+            found.append('throughput %.1f docs/s, %.1f docs/s in previous '
+                         'runs' % (run['throughput'], throughput))
+
+        dump_duration = average(prev.get('dump_duration')
+                                for prev in previous)
+        if dump_duration and run['dump_duration'] and \
+                run['dump_duration'] > dump_duration * factor:
+            found.append('mongo dump took %.1fs, %.1fs in previous runs' %
+                         (run['dump_duration'], dump_duration))
+
+        for migration in run['migrations']:
+            wall_time = average(prev_migration['wall_time']
+                                for prev in previous
+                                for prev_migration in prev['migrations']
+                                if prev_migration['name'] ==
+                                migration['name'])
+            if wall_time and migration['wall_time'] > wall_time * factor:
+                found.append('%s took %.1fs, %.1fs in previous runs' %
+                             (migration['name'], migration['wall_time'],
+                              wall_time))
+        return found
+
+    def migration_progress(self, migr):
+        """Returns Progress of given migration, configured by PROGRESS_*
+        attributes"""
+        return Progress(migr, self.logger, self.PROGRESS_INTERVAL,
+                        self.PROGRESS_FORMAT, database=self.MONGO_DATABASE)
+
+    def dependencies(self, migr_mods):
+        """Builds graph of dependencies between given migrations (pairs of
+        name and module, in order of execution). Returns dict of sets of
+        migrations which have to be executed before each migration.
+
+        Migrations can declare DEPENDS_ON list of migrations and COLLECTIONS
+        list which they touch. Migrations touching the same collections are
+        executed in order of their numbers, as well as migrations which
+        declare nothing."""
+        names = set(migr for migr, migr_mod in migr_mods)
+        depends_on = {}
+        collections = {}
+        for migr, migr_mod in migr_mods:
+            depends_on[migr] = set(
+                dep if dep.endswith('.py') else dep + '.py'
+                for dep in declared(migr_mod, 'DEPENDS_ON', []))
+            collections[migr] = migration_collections(migr_mod)
+
+        missing = set()
+        for migr in names:
+            missing |= depends_on[migr] - names
+        missing -= self.registered(list(missing))
+        if missing:
+            raise MigopyException('Migrations %s required but not found' %
+                                  ', '.join(sorted(missing)))
+
+        graph = {}
+        for i, (migr, migr_mod) in enumerate(migr_mods):
+            undeclared = not depends_on[migr] and collections[migr] is None
+            graph[migr] = depends_on[migr] & names
+            for prev, prev_mod in migr_mods[:i]:
+                prev_undeclared = not depends_on[prev] and \
+                    collections[prev] is None
+                if undeclared or prev_undeclared or \
+                        set(collections[migr] or []) & \
+                        set(collections[prev] or []):
+                    graph[migr].add(prev)
+        return graph
+
+    def run_scheduled(self, unreg_migr, executed=None):
+        """Executes migrations concurrently, in pool of EXECUTE_WORKERS
+        threads, in order given by dependencies between them. Each migration
+        is registered as soon as it's finished (and appended to executed
+        list, with its record, when it's given)."""
+        migr_mods = [(migr, load_migration(self.MIGRATIONS_DIRECTORY, migr))
+                     for migr in unreg_migr]
+        graph = self.dependencies(migr_mods)
+        migr_mods = dict(migr_mods)
+
+        def run(migr):
+            try:
+                record = self.execute_migration(migr, migr_mods[migr])
+                return migr, None, record
+            except Exception:
+                return migr, traceback.format_exc(), None
+            finally:
+                unload_migration(migr_mods[migr])
+
+        waiting = list(unreg_migr)
+        running = set()
+        done = set()
+        failed = []
+        try:
+            import queue
+        except ImportError:
+            import Queue as queue
+
+        results = queue.Queue()
+        pool = thread_pool(self.EXECUTE_WORKERS)
+        try:
+            while waiting or running:
+                for migr in list(waiting):
+                    if failed or len(running) >= self.EXECUTE_WORKERS:
+                        break
+                    if graph[migr] <= done:
+                        self.logger.white_bold('Executing migration %s...' %
+                                               migr)
+                        waiting.remove(migr)
+                        running.add(migr)
+                        pool.apply_async(run, (migr,), callback=results.put)
+
+                if not running:
+                    if waiting and not failed:
+                        raise MigopyException(
+                            'Circular dependencies between migrations %s' %
+                            ', '.join(waiting))
+                    break
+
+                try:
+                    # timeout keeps waiting interruptible
+                    migr, error, record = results.get(True, 1)
+                except queue.Empty:
+                    continue
+                running.remove(migr)
+                if error:
+                    failed.append(migr)
+                    self.logger.red('Migration %s failed:\n%s' %
+                                    (migr, error))
+                else:
+                    self.register([migr], {'execute': record})
+                    done.add(migr)
+                    if executed is not None:
+                        executed.append((migr, record))
+        finally:
+            pool.close()
+            pool.join()
+            for migr in waiting:
+                unload_migration(migr_mods[migr])
+
+        if failed:
+            raise MigopyException('Migrations failed: %s' % ', '.join(failed))
+
+    def run_up(self, migr, migr_mod, created=None):
+        """Executes up() of migration module, see run_up_function(). Indexes
+        declared in INDEXES are built after that (up() is optional in such
+        migrations) and the built ones are appended to created list."""
+        indexes = declared(migr_mod, 'INDEXES')
+        result = None
+        if indexes is None or any(declared(migr_mod, name) is not None
+                                  for name in ('up', 'transform', 'PIPELINE')):
+            result = self.run_up_function(migr, migr_mod)
+        if indexes is not None:
+            self.build_indexes(indexes, created)
+        return result
+
+    def run_up_function(self, migr, migr_mod):
+        """Executes up() of migration module. Resumable migrations (with
+        RESUMABLE = True declared) get also their checkpoint. Migrations
+        declaring COLLECTION and transform() function are executed in
+        parallel, by ranges of _id. Migrations declaring PIPELINE are
+        executed on the server."""
+        if declared(migr_mod, 'COLLECTION') and declared(migr_mod, 'transform'):
+            return self.run_partitioned(migr, migr_mod)
+        if declared(migr_mod, 'PIPELINE') is not None:
+            return self.run_pipelines(declared(migr_mod, 'PIPELINE'))
+        if declared(migr_mod, 'RESUMABLE') is True:
+            return self.call(migr_mod.up, self.checkpoint(migr))
+        return self.call(migr_mod.up)
+
+    def run_down(self, migr_mod, created=None):
+        """Executes down() of migration module, or its DOWN_PIPELINE. Indexes
+        declared in INDEXES are dropped before that (down() is optional in
+        such migrations), but only ones created by execution of migration,
+        given as created list of collection and index names."""
+        indexes = declared(migr_mod, 'INDEXES')
+        if indexes is not None and created:
+            self.drop_indexes(created)
+        if declared(migr_mod, 'DOWN_PIPELINE') is not None:
+            return self.run_pipelines(declared(migr_mod, 'DOWN_PIPELINE'))
+        if indexes is None or declared(migr_mod, 'down') is not None:
+            return self.call(migr_mod.down)
+        return None
+
+    def build_indexes(self, indexes, created=None):
+        """Builds indexes, given as lists by collection names, skipping ones
+        which already exist with the same spec. Collections are indexed
+        concurrently, in pool of INDEX_BUILD_WORKERS threads, and progress
+        of builds (from currentOp) is reported every INDEX_POLL_INTERVAL
+        seconds. Collection and index names of built indexes are appended
+        to created list, when it's given."""
+        missing = {}
+        for name in sorted(indexes):
+            information = self.db[name].index_information()
+            for spec in map(index_spec, indexes[name]):
+                if spec.find_in(information):
+                    self.logger.white('%s: index %s already exists' %
+                                      (name, spec.name()))
+                else:
+                    missing.setdefault(name, []).append(spec)
+        if not missing:
+            return None
+
+        def build(name):
+            for spec in missing[name]:
+                self.logger.white_bold('%s: building index %s...' %
+                                       (name, spec.name()))
+                spec.create(self.db[name])
+                if created is not None:
+                    created.append([name, spec.name()])
+
+        pool = thread_pool(min(self.INDEX_BUILD_WORKERS, len(missing)))
+        try:
+            result = pool.map_async(build, sorted(missing))
+            started = {}
+            while not result.ready():
+                result.wait(self.INDEX_POLL_INTERVAL)
+                if not result.ready():
+                    self.report_index_builds(missing, started)
+            result.get()
+        finally:
+            pool.close()
+            pool.join()
+
+    def report_index_builds(self, collections, started):
+        """Logs progress of index builds of given collections, with percent
+        of work done and ETA computed from progress since build was seen
+        first time (kept in started dict by operation id)"""
+        namespaces = set('%s.%s' % (self.db.name, name)
+                         for name in collections)
+        operations = self.db.client.admin.command('currentOp')
+        now = time.time()
+        for operation in operations.get('inprog', []):
+            progress = operation.get('progress') or {}
+            if operation.get('ns') not in namespaces or \
+                    not progress.get('total'):
+                continue
+            done, total = progress.get('done', 0), progress['total']
+            first_time, first_done = started.setdefault(operation.get('opid'),
+                                                        (now, done))
+            eta = 'unknown'
+            if done > first_done:
+                eta = '%ds' % ((total - done) * (now - first_time) /
+                               (done - first_done))
+            self.logger.white('%s: index build %d%% (%d of %d), ETA %s' %
+                              (operation['ns'], 100 * done // total, done,
+                               total, eta))
+
+    def drop_indexes(self, indexes):
+        """Drops indexes, given as pairs of collection and index names,
+        which exist"""
+        for name, index_name in sorted(indexes):
+            if index_name in self.db[name].index_information():
+                self.logger.white('%s: dropping index %s' %
+                                  (name, index_name))
+                self.db[name].drop_index(index_name)
+
+    def run_pipelines(self, pipelines):
+        """Applies aggregation pipelines, given by collection names, on the
+        server, without fetching documents. Pipelines made only of stages
+        allowed in updates are applied by update_many(), other ones by
+        $merge of their results into the same collection. Returns numbers of
+        documents modified by updates."""
+        counts = {}
+        for name in sorted(pipelines):
+            stages = list(pipelines[name])
+            collection = self.db[name]
+            if all(len(stage) == 1 and list(stage)[0] in UPDATE_PIPELINE_STAGES
+                   for stage in stages):
+                result = collection.update_many({}, stages)
+                counts[name] = result.modified_count
+            else:
+                collection.aggregate(stages + [{'$merge': {
+                    'into': name,
+                    'on': '_id',
+                    'whenMatched': 'replace',
+                    'whenNotMatched': 'discard'}}])
+        return counts
+
+    def call(self, func, *args):
+        """Calls up() or down() function of migration with database as the
+        first argument. Coroutine functions are run on new event loop,
+        with database of async driver. Operations yielded by generator
+        functions are applied by apply_operations(). rewrite() called by
+        the function is throttled, when THROTTLE is on, and logs to logger
+        of this manager."""
+        import inspect
+        with throttling(self.throttle_options()), logging_to(self.logger):
+            if is_coroutine_function(func):
+                return self.run_async(func, *args)
+            if inspect.isgeneratorfunction(func):
+                return self.apply_operations(func(self.db, *args))
+            return func(self.db, *args)
+
+    def apply_operations(self, operations):
+        """Applies write operations of generator migration, given as
+        (collection name, operation) pairs and consumed lazily. Operations
+        are buffered by collection and sent in ordered bulk writes of
+        GENERATOR_BATCH_SIZE operations (or size chosen by throttle, when
+        THROTTLE is on), so only one batch per collection is kept in
+        memory. When some buffer is full, all buffers are written, in order
+        of their first operations. Indexes (CreateIndex or pymongo's
+        IndexModel) are created after writing all operations yielded before
+        them. Returns numbers of applied write operations by collection."""
+        import pymongo
+        index_models = tuple(filter(None, [getattr(pymongo, 'IndexModel',
+                                                   None)]))
+        throttle = self.throttle(self.GENERATOR_BATCH_SIZE)
+        counts = {}
+
+        def flush(name, requests):
+            started = time.time()
+            self.db[name].bulk_write(requests, ordered=True)
+            latency = time.time() - started
+            if throttle:
+                throttle.observe(latency)
+            observe_batch(latency)
+            counts[name] = counts.get(name, 0) + len(requests)
+            self.logger.white('%s: %d operations applied' %
+                              (name, counts[name]))
+            progress(sum(counts.values()))
+
+        buffers = collections.OrderedDict()
+
+        def flush_all():
+            while buffers:
+                flush(*buffers.popitem(last=False))
+
+        for collection, operation in operations:
+            if isinstance(operation, (CreateIndex,) + index_models):
+                flush_all()
+                if isinstance(operation, CreateIndex):
+                    operation.create(self.db[collection])
+                else:
+                    self.db[collection].create_indexes([operation])
+                continue
+            requests = buffers.setdefault(collection, [])
+            requests.append(operation)
+            if len(requests) >= (throttle.batch_size if throttle
+                                 else self.GENERATOR_BATCH_SIZE):
+                flush_all()
+
+        flush_all()
+        return counts
+
+    def run_async(self, func, *args):
+        """Runs coroutine function on new event loop, with database of
+        AsyncMongoClient (motor by default) connected for this run"""
+        import asyncio
+        client_class = self.AsyncMongoClient
+        if client_class is None:
+            from motor.motor_asyncio import AsyncIOMotorClient as client_class
+
+        options = {}
+        if self.MONGO_USER and self.MONGO_USER_PASS:
+            options = {'username': self.MONGO_USER,
+                       'password': self.MONGO_USER_PASS,
+                       'authSource': self.MONGO_DATABASE}
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        try:
+            client = client_class(self.MONGO_HOST, self.MONGO_PORT, **options)
+            try:
+                return loop.run_until_complete(
+                    func(client[self.MONGO_DATABASE], *args))
+            finally:
+                client.close()
+        finally:
+            asyncio.set_event_loop(None)
+            loop.close()
+
+    def throttle_options(self):
+        """Returns options of Throttle given in THROTTLE_* attributes, None
+        when throttling is off"""
+        if not self.THROTTLE:
+            return None
+        return {'min_batch_size': self.THROTTLE_MIN_BATCH_SIZE,
+                'max_lag': self.THROTTLE_MAX_LAG,
+                'max_latency': self.THROTTLE_MAX_LATENCY,
+                'pause': self.THROTTLE_PAUSE,
+                'check_interval': self.THROTTLE_CHECK_INTERVAL}
+
+    def throttle(self, batch_size, db=None):
+        """Returns Throttle for batched writes configured by THROTTLE_*
+        attributes, None when THROTTLE is off"""
+        options = self.throttle_options()
+        if options is None:
+            return None
+        return Throttle(db or self.db, batch_size, **options)
+
+    def split_ranges(self, collection, count):
+        """Splits collection into given number of _id ranges, by split points
+        taken from sample of documents. Returns list of (min, max) pairs,
+        where None means unbounded range. Mongo compares _id in ranges only
+        with values of the same type, so the first range takes also _id of
+        other types (see rewrite_range()) and collections with sampled _id
+        of mixed types are not split at all."""
+        pipeline = [{'$sample': {'size': count * self.PARALLEL_SAMPLES}},
+                    {'$project': {'_id': True}}]
+        result = collection.aggregate(pipeline)
+        if isinstance(result, dict):
+            # pymongo 2.x without cursor option
+            result = result['result']
+        ids = set(doc['_id'] for doc in result)
+        types = set('number' if isinstance(_id, numbers.Number) and
+                    not isinstance(_id, bool) else type(_id) for _id in ids)
+        if len(types) > 1:
+            return [(None, None)]
+        ids = sorted(ids)
+        points = sorted(set(ids[len(ids) * i // count]
+                            for i in range(1, count) if ids))
+        bounds = [None] + points + [None]
+        return list(zip(bounds[:-1], bounds[1:]))
+
+    def partition_pool(self, workers):
+        import multiprocessing
+        return multiprocessing.Pool(workers, initializer=forget_reporters)
+
+    def run_partitioned(self, migr, migr_mod):
+        """Executes transform() of migration module on documents of
+        declared COLLECTION, in pool of PARALLEL_WORKERS processes. Each
+        process has own connection with mongo and rewrites one range of
+        _id at once. Progress and latencies of batches are reported by
+        this process, as results of ranges come. Returns number of
+        processed documents."""
+        import multiprocessing
+        workers = self.PARALLEL_WORKERS or multiprocessing.cpu_count()
+        collection = self.db[declared(migr_mod, 'COLLECTION')]
+        ranges = self.split_ranges(collection, workers *
+                                   self.PARALLEL_RANGES_PER_WORKER)
+        connection = {'MongoClient': self.MongoClient,
+                      'host': self.MONGO_HOST,
+                      'port': self.MONGO_PORT,
+                      'database': self.MONGO_DATABASE,
+                      'user': self.MONGO_USER,
+                      'password': self.MONGO_USER_PASS,
+                      'directory': self.MIGRATIONS_DIRECTORY,
+                      'batch_size': self.PARALLEL_BATCH_SIZE,
+                      'throttle': self.throttle_options()}
+        tasks = [(connection, migr, id_range) for id_range in ranges]
+        total = None
+        if progress_reporter() is not None and \
+                declared(migr_mod, 'QUERY') is None:
+            total = estimated_count(collection)
+        processed = 0
+        failed = 0
+        pool = self.partition_pool(workers)
+        try:
+            for id_range, count, latencies, error in \
+                    pool.imap_unordered(rewrite_range, tasks):
+                processed += count
+                progress(processed, total)
+                for latency in latencies:
+                    observe_batch(latency)
+                if error:
+                    failed += 1
+                    self.logger.red('Range %s - %s of %s failed:\n%s' %
+                                    (id_range + (migr, error)))
+                else:
+                    self.logger.white('Range %s - %s of %s: %d documents' %
+                                      (id_range + (migr, count)))
+        finally:
+            pool.close()
+            pool.join()
+
+        if failed:
+            raise MigopyException('Migration %s failed in %d of %d ranges' %
+                                  (migr, failed, len(ranges)))
+        return processed
 
     @task
     def ignore(self, spec_migr=None):
         """Register migrations without executing"""
+        if self.MONGO_DATABASES:
+            return self.fan_out('ignore', spec_migr)
+
         unreg_migr = self.unregistered()
         if not unreg_migr:
             self.show_status()
@@ -231,45 +1981,407 @@ class MigrationsManager(object):
 
         for migr in unreg_migr:
             self.logger.white_bold('Registering migration %s...' % migr)
-            self.collection.insert({'name': migr})
+        self.register(unreg_migr)
 
     @task
     def rollback(self, spec_migr):
         """Rollback specyfic migration"""
+        if self.MONGO_DATABASES:
+            return self.fan_out('rollback', spec_migr)
+
         if spec_migr not in self.unregistered():
             raise MigopyException(('Migration %s is not on unregistred ' +
                                    'migrations list. Can not be executed') %
                                   spec_migr)
-        spec_migr_name = re.sub('\.py$', '', spec_migr)
-        with cwd_in_syspath():
-            migr_mod = importlib.import_module('%s.%s' %
-                                    (self.MIGRATIONS_DIRECTORY, spec_migr_name))
         self.logger.white_bold('Rollback migration %s...' % spec_migr)
-        migr_mod.down(self.db)
-        self.collection.remove({'name': spec_migr})
+        registration = self.collection.find_one({'name': spec_migr}) or {}
+        created = (registration.get('execute') or {}).get('indexes')
+        with loaded_migration(self.MIGRATIONS_DIRECTORY,
+                              spec_migr) as migr_mod:
+            result, record = self.measure(self.run_down, migr_mod, created)
+        self.unregister(spec_migr, {'rollback': record})
+
+    def unregister(self, migr, fields=None):
+        """Marks migration as not registered, keeping record of its
+        execution in its document with given fields"""
+        self.collection.update_one(
+            {'name': migr},
+            {'$set': dict(fields or {}, registered=False),
+             '$unset': {'checkpoint': '', 'processed': ''}},
+            upsert=True)
+        bump_version(self.collection)
+
+    def measure(self, func, *args):
+        """Calls given function and measures its execution. Returns result
+        of the function and record of execution with start and end time,
+        wall and CPU time (in seconds), host name and number of documents
+        returned by the function (as number or dict of numbers)."""
+        started = datetime.datetime.utcnow()
+        wall_started = time.time()
+        cpu_started = cpu_time()
+        result = func(*args)
+        record = {'started': started,
+                  'finished': datetime.datetime.utcnow(),
+                  'wall_time': time.time() - wall_started,
+                  'cpu_time': cpu_time() - cpu_started,
+                  'host': socket.gethostname()}
+        if isinstance(result, dict):
+            record['docs'] = sum(result.values())
+            record['counts'] = result
+        elif isinstance(result, numbers.Integral) and \
+                not isinstance(result, bool):
+            record['docs'] = result
+        return result, record
+
+    @task
+    def stats(self, spec_migr=None):
+        """Show the slowest migrations or compare one between environments"""
+        import pymongo
+        if self.MONGO_DATABASES:
+            return self.fan_out('stats', spec_migr)
+
+        if not spec_migr:
+            records = self.collection.find(
+                {'execute.wall_time': {'$exists': True}},
+                sort=[('execute.wall_time', pymongo.DESCENDING)],
+                limit=self.STATS_LIMIT)
+            self.logger.white_bold('The slowest migrations:')
+            for record in records:
+                self.logger.white(format_record(record['name'],
+                                                record['execute']))
+            return None
+
+        import pymongo.errors
+        environments = [(self.ENVIRONMENT, self.collection)]
+        clients = []
+        try:
+            for env, uri in sorted(self.STATS_ENVIRONMENTS.items()):
+                try:
+                    client = connect(self.MongoClient, uri)
+                    clients.append(client)
+                    db = client.get_default_database()
+                except pymongo.errors.PyMongoError as e:
+                    # URI is not shown, it can contain password
+                    raise MigopyException(
+                        'Can not connect with %s environment (URI with '
+                        'database name required): %s' % (env, e))
+                environments.append((env, db[self.MIGRATIONS_COLLECTION]))
+
+            self.logger.white_bold('Migration %s:' % spec_migr)
+            for env, collection in environments:
+                record = collection.find_one({'name': spec_migr}) or {}
+                if 'execute' in record:
+                    self.logger.white(format_record(env, record['execute']))
+                else:
+                    self.logger.red('%s: not executed' % env)
+        finally:
+            for client in clients:
+                client.close()
+
+    @task
+    def profile(self, spec_migr):
+        """Execute specyfic migration under profiler, without registering"""
+        import cProfile
+        import pstats
+        try:
+            from StringIO import StringIO
+        except ImportError:
+            from io import StringIO
+
+        if self.MONGO_DATABASES:
+            # profiles are comparable only for one database at once
+            if '/' not in spec_migr:
+                raise MigopyException(
+                    'Migration should be given as database/migration when '
+                    'MONGO_DATABASES are set')
+            database, spec_migr = spec_migr.split('/', 1)
+            return self.tenant(database).profile(spec_migr)
+
+        if spec_migr not in self.unregistered():
+            raise MigopyException(('Migration %s is not on unregistred ' +
+                                   'migrations list. Can not be executed') %
+                                  spec_migr)
+
+        if not os.path.exists(self.PROFILE_DIRECTORY):
+            os.makedirs(self.PROFILE_DIRECTORY)
+        filename = re.sub('[:\.\s]', '_', str(datetime.datetime.now()))
+        path = '%s/%s_%s.pstats' % (self.PROFILE_DIRECTORY,
+                                    re.sub('\.py$', '', spec_migr), filename)
+
+        self.logger.white_bold('Profiling migration %s...' % spec_migr)
+        profiler = cProfile.Profile()
+        created = []
+        with loaded_migration(self.MIGRATIONS_DIRECTORY,
+                              spec_migr) as migr_mod:
+            result, record = self.measure(profiler.runcall, self.run_up,
+                                          spec_migr, migr_mod, created)
+        profiler.dump_stats(path)
+        if created:
+            record['indexes'] = created
+
+        stream = StringIO()
+        stats = pstats.Stats(path, stream=stream)
+        stats.sort_stats(self.PROFILE_SORT).print_stats(self.PROFILE_TOP)
+        for line in stream.getvalue().splitlines():
+            self.logger.white(line)
+        self.logger.white_bold('Profile saved in %s' % path)
+
+        if self.PROFILE_REGISTER:
+            self.register([spec_migr], {'execute': record})
+
+    def snapshot(self, migr, migr_mod):
+        """Copies collections declared by migration into backup collections
+        on the server side (by aggregation with $out). Specifications of
+        indexes are kept in snapshot's document in migrations collection,
+        to rebuild them after restore. Old snapshots over
+        MONGO_SNAPSHOT_KEEP are dropped."""
+        collections = migration_collections(migr_mod)
+        if collections is None:
+            raise MigopyException(('Migration %s does not declare ' +
+                                   'COLLECTIONS, snapshot can not be done') %
+                                  migr)
+
+        stamp = re.sub('[:\.\s]', '_', str(datetime.datetime.now()))
+        self.logger.white_bold('Doing snapshot of %s...' %
+                               ', '.join(collections))
+        backups = {}
+        indexes = {}
+        for collection in collections:
+            backups[collection] = '%s.%s.%s' % (self.MONGO_SNAPSHOT_PREFIX,
+                                                stamp, collection)
+            self.db[collection].aggregate([{'$match': {}},
+                                           {'$out': backups[collection]}])
+            indexes[collection] = [
+                dict(info, name=name) for name, info in
+                self.db[collection].index_information().items()
+                if name != '_id_']
+
+        self.collection.insert_one({'name': 'migopy:snapshot:%s' % stamp,
+                                    'migration': migr,
+                                    'backups': backups,
+                                    'indexes': indexes,
+                                    'created': datetime.datetime.utcnow()})
+        self.drop_snapshots(self.MONGO_SNAPSHOT_KEEP)
+
+    def snapshots(self):
+        """Returns documents of snapshots, the newest first"""
+        import pymongo
+        return list(self.collection.find(
+            {'name': {'$regex': '^migopy:snapshot:'}},
+            sort=[('created', pymongo.DESCENDING)]))
+
+    def drop_snapshots(self, keep):
+        """Drops snapshots, except given number of the newest"""
+        for snapshot in self.snapshots()[keep:]:
+            for backup in snapshot['backups'].values():
+                self.db.drop_collection(backup)
+            self.collection.delete_one({'name': snapshot['name']})
+
+    @task
+    def restore_snapshot(self, spec_snapshot=None):
+        """Restore the newest snapshot (or given snapshot or migration)"""
+        if self.MONGO_DATABASES:
+            return self.fan_out('restore_snapshot', spec_snapshot)
+
+        snapshots = [snapshot for snapshot in self.snapshots()
+                     if not spec_snapshot or spec_snapshot in
+                     (snapshot['name'].split(':', 2)[2],
+                      snapshot['migration'])]
+        if not snapshots:
+            raise MigopyException('Snapshot %s not found' %
+                                  (spec_snapshot or ''))
+
+        snapshot = snapshots[0]
+        self.logger.white_bold('Restoring snapshot %s of migration %s...' %
+                               (snapshot['name'].split(':', 2)[2],
+                                snapshot['migration']))
+        for collection, backup in sorted(snapshot['backups'].items()):
+            self.db[backup].rename(collection, dropTarget=True)
+            for index in snapshot['indexes'][collection]:
+                options = dict((option, value) for option, value
+                               in index.items()
+                               if option not in ('key', 'v', 'ns'))
+                self.db[collection].create_index(
+                    [tuple(key) for key in index['key']], **options)
+        self.collection.delete_one({'name': snapshot['name']})
+        self.unregister(snapshot['migration'])
+
+    def dump_collections(self, migrations):
+        """Returns sorted list of collections declared by given migrations,
+        None when some of them don't declare collections or no migrations
+        given (whole database has to be dumped)"""
+        if not self.MONGO_DUMP_SELECTIVE or not migrations:
+            return None
+
+        collections = set()
+        for migr in migrations:
+            with loaded_migration(self.MIGRATIONS_DIRECTORY,
+                                  migr) as migr_mod:
+                migr_collections = migration_collections(migr_mod)
+            if migr_collections is None:
+                return None
+            collections.update(migr_collections)
+        return sorted(collections)
+
+    def dump_command(self, path, collection=None):
+        command = 'mongodump -d %s' % self.MONGO_DATABASE
+        if self.MONGO_DUMP_ARCHIVE:
+            command += ' --archive=%s/%s.archive%s' % (
+                path, collection or self.MONGO_DATABASE,
+                '.gz' if self.MONGO_DUMP_GZIP else '')
+        else:
+            command += ' -o %s' % path
+        if collection:
+            command += ' -c %s' % collection
+        if self.MONGO_DUMP_GZIP:
+            command += ' --gzip'
+        if self.MONGO_USER and self.MONGO_USER_PASS:
+            command += ' -u %s -p %s' % (self.MONGO_USER, self.MONGO_USER_PASS)
+        return command
 
     @task
-    def dbdump(self):
+    def dbdump(self, spec_migr=None):
         """Do mongo dump"""
+        if self.MONGO_DATABASES:
+            return self.fan_out('dbdump', spec_migr)
+
         if not self.MONGO_DATABASE:
             raise MigopyException("Name of mongo database not given")
 
+        if spec_migr:
+            migrations = [spec_migr]
+        elif os.path.exists(self.MIGRATIONS_DIRECTORY):
+            migrations = self.unregistered()
+        else:
+            migrations = []
+        collections = self.dump_collections(migrations)
+
         filename = re.sub('[:\.\s]', '_', str(datetime.datetime.now()))
         path = '%s/%s' % (self.MONGO_DUMP_DIRECTORY, filename)
-        command = 'mongodump -d %s -o %s' % (self.MONGO_DATABASE, path)
-        if self.MONGO_USER and self.MONGO_USER_PASS:
-            command += '-u %s -p %s' % (self.MONGO_USER, self.MONGO_USER_PASS)
+        if self.MONGO_DUMP_ARCHIVE and not os.path.exists(path):
+            os.makedirs(path)
 
         self.logger.white_bold('Doing mongo dump...')
-        local(command)
+        started = time.time()
+        if collections:
+            commands = [self.dump_command(path, collection)
+                        for collection in collections]
+            failed = run_commands(commands, self.MONGO_DUMP_WORKERS)
+            if failed:
+                raise MigopyException(
+                    'Mongo dump of collections %s failed' %
+                    ', '.join(collection for collection, command
+                              in zip(collections, commands)
+                              if command in failed))
+        elif not local(self.dump_command(path)):
+            raise MigopyException('Mongo dump of database %s failed' %
+                                  self.MONGO_DATABASE)
+
+        size = 0
+        for dirpath, dirnames, filenames in os.walk(path):
+            size += sum(os.path.getsize(os.path.join(dirpath, fname))
+                        for fname in filenames)
+        record = {'name': 'migopy:dump:%s' % filename,
+                  'path': path,
+                  'size': size,
+                  'collections': collections,
+                  'migrations': migrations,
+                  'created': datetime.datetime.utcnow(),
+                  'duration': time.time() - started}
+        self.collection.insert_one(record)
+        self.logger.white('Mongo dump saved in %s (%d bytes)' % (path, size))
+        self.metric('migopy_dump_duration_seconds', record['duration'])
+        return record
+
+    def restore_commands(self, path):
+        """Returns mongorestore commands restoring dump from given path,
+        one per archive file or one for dump directory"""
+        options = ' --drop --numParallelCollections=%d ' \
+                  '--numInsertionWorkersPerCollection=%d' % (
+                      self.MONGO_RESTORE_PARALLEL_COLLECTIONS,
+                      self.MONGO_RESTORE_INSERTION_WORKERS)
+        if self.MONGO_USER and self.MONGO_USER_PASS:
+            options += ' -u %s -p %s' % (self.MONGO_USER, self.MONGO_USER_PASS)
+
+        archives = sorted(fname for fname in os.listdir(path)
+                          if re.search('\.archive(\.gz)?$', fname))
+        if archives:
+            return ['mongorestore --archive=%s/%s%s%s' %
+                    (path, fname, ' --gzip' if fname.endswith('.gz') else '',
+                     options) for fname in archives]
+
+        db_path = '%s/%s' % (path, self.MONGO_DATABASE)
+        gzip = any(fname.endswith('.gz') for fname in os.listdir(db_path))
+        return ['mongorestore -d %s --dir=%s%s%s' %
+                (self.MONGO_DATABASE, db_path, ' --gzip' if gzip else '',
+                 options)]
+
+    @task
+    def dbrestore(self, spec_dump=None):
+        """Restore the newest mongo dump (or given one)"""
+        if self.MONGO_DATABASES:
+            # dumps of databases differ, so given one is restored only in
+            # its database
+            if spec_dump:
+                if '/' not in spec_dump:
+                    raise MigopyException(
+                        'Mongo dump should be given as database/dump when '
+                        'MONGO_DATABASES are set')
+                database, spec_dump = spec_dump.split('/', 1)
+                return self.tenant(database).dbrestore(spec_dump)
+            return self.fan_out('dbrestore')
+
+        if not self.MONGO_DATABASE:
+            raise MigopyException("Name of mongo database not given")
+
+        dumps = []
+        if os.path.exists(self.MONGO_DUMP_DIRECTORY):
+            dumps = sorted(os.listdir(self.MONGO_DUMP_DIRECTORY))
+        if not dumps or (spec_dump and spec_dump not in dumps):
+            raise MigopyException('Mongo dump %s not found in %s' %
+                                  (spec_dump or '', self.MONGO_DUMP_DIRECTORY))
+
+        dump = spec_dump or dumps[-1]
+        path = '%s/%s' % (self.MONGO_DUMP_DIRECTORY, dump)
+        # restored dump can contain migrations collection without dump record
+        record = self.collection.find_one({'name': 'migopy:dump:%s' % dump})
+        applied = set()
+        if record:
+            applied.update(record['migrations'])
+            applied.update(registration['name'] for registration in
+                           self.collection.find(
+                               {'execute.finished': {'$gt': record['created']}},
+                               {'name': True}))
+
+        self.logger.white_bold('Restoring mongo dump %s...' % path)
+        commands = self.restore_commands(path)
+        failed = run_commands(commands, self.MONGO_DUMP_WORKERS)
+        if failed:
+            # migrations are left registered, database is in unknown state
+            raise MigopyException('Mongo restore of %s failed (%d of %d '
+                                  'mongorestore commands)' %
+                                  (path, len(failed), len(commands)))
+
+        if not record:
+            self.logger.red(('Mongo dump %s not recorded, migrations ' +
+                             'executed after it are not unregistered') % dump)
+            return None
+
+        if applied:
+            self.collection.update_many(
+                {'name': {'$in': sorted(applied)}},
+                {'$set': {'registered': False},
+                 '$unset': {'checkpoint': '', 'processed': ''}})
+            bump_version(self.collection)
+            self.logger.white('Unregistered migrations: %s' %
+                              ', '.join(sorted(applied)))
 
     @staticmethod
     def tasks(migr_mng):
         """It returns all migopy tasks"""
-        for attr_name in dir(migr_mng):
+        for attr_name in migr_mng.migopy_tasks:
             attr = getattr(migr_mng, attr_name)
-            if hasattr(attr, 'migopy_task') and (attr.migopy_task == True or
-                attr.migopy_task == 'default'):
+            if is_task(attr):
                 yield attr
 
     @task
@@ -296,6 +2408,61 @@ class MigrationsManager(object):
     def task_hook(cls, subtask, option):
         pass
 
+    @classmethod
+    def remote_command(cls, host, command):
+        """Returns arguments of process running given command on remote host
+        (by ssh, in REMOTE_DIRECTORY when it's given)"""
+        if cls.REMOTE_DIRECTORY:
+            command = 'cd %s && %s' % (cls.REMOTE_DIRECTORY, command)
+        return ['ssh', host, command]
+
+    @classmethod
+    def run_on_hosts(cls, hosts, subtask=None, option=None, workers=None):
+        """Runs fab command of given subtask on remote hosts in parallel, at
+        most REMOTE_WORKERS (or given number of) hosts at once. Output of
+        each host is logged with its name, when host is done. Raises
+        MigopyException when command failed on any host."""
+        import subprocess
+        if not hosts:
+            return None
+
+        command = cls.fab_command(subtask, option)
+
+        def run(host):
+            try:
+                process = subprocess.Popen(cls.remote_command(host, command),
+                                           stdout=subprocess.PIPE,
+                                           stderr=subprocess.STDOUT)
+                output = process.communicate()[0]
+                return host, process.returncode, output.decode('utf-8',
+                                                               'replace')
+            except OSError as e:
+                return host, None, str(e)
+
+        results = {}
+        pool = thread_pool(min(workers or cls.REMOTE_WORKERS, len(hosts)))
+        try:
+            for host, returncode, output in pool.imap_unordered(run, hosts):
+                for line in output.splitlines():
+                    cls.logger.white('[%s] %s' % (host, line))
+                results[host] = returncode
+        finally:
+            pool.close()
+            pool.join()
+
+        cls.logger.white_bold('Summary of %d hosts:' % len(hosts))
+        failed = []
+        for host in hosts:
+            if results[host] == 0:
+                cls.logger.green('%s - done' % host)
+            else:
+                failed.append(host)
+                cls.logger.red('%s - failed (exit code %s)' %
+                               (host, results[host]))
+        if failed:
+            raise MigopyException('Failed on %d of %d hosts: %s' %
+                                  (len(failed), len(hosts), ', '.join(failed)))
+
     @classmethod
     def create_task(cls):
         def migrations(subtask=None, spec_migr=None):
@@ -325,3 +2492,146 @@ class MigrationsManager(object):
                 cls.logger.red(e.message)
 
         return migrations
+
+
+def rewrite(collection, update_func, query=None, projection=None,
+            batch_size=1000, logger=None, checkpoint=None, throttle=None):
+    """Helper for migrations which rewrite documents of collection, e.g.:
+
+        def up(db):
+            migopy.rewrite(db.notes, lambda doc: {'$set': {'x': doc['y']}},
+                           projection={'y': True})
+
+    Documents matched by query are streamed from cursor and passed to
+    update_func, which returns update document for given document, write
+    operation (like pymongo.DeleteOne) or None when document should be left
+    untouched. Updates are sent to mongo in unordered bulk writes of
+    batch_size operations. Returns number of processed documents.
+
+    When checkpoint of resumable migration is given, documents are
+    processed in _id order, starting after the checkpoint, and checkpoint
+    is saved after each batch. Throttle decides about size of batches: by
+    default throttle of executed migration is used (when THROTTLE of its
+    migrations manager is on), throttle=False turns it off. Progress of
+    executed migration is reported after each batch, as well as latency of
+    bulk writes to its metrics sink. Messages go to logger of executing
+    migrations manager, unless logger is given."""
+    import pymongo
+    logger = logger or current_logger()
+    total = None
+    if progress_reporter() is not None and not query:
+        total = estimated_count(collection)
+    query = query or {}
+    options = {'batch_size': batch_size}
+    resumed = 0
+    if throttle is None:
+        throttle = current_throttle(collection.database, batch_size)
+    if checkpoint:
+        resumed = checkpoint.processed
+        options['sort'] = [('_id', pymongo.ASCENDING)]
+        if checkpoint.value is not None:
+            resume_query = {'_id': {'$gt': checkpoint.value}}
+            query = {'$and': [query, resume_query]} if query else resume_query
+
+    cursor = collection.find(query, projection, **options)
+    requests = []
+    processed = 0
+    for doc in cursor:
+        update = update_func(doc)
+        processed += 1
+        if isinstance(update, dict):
+            requests.append(pymongo.UpdateOne({'_id': doc['_id']}, update))
+        elif update is not None:
+            requests.append(update)
+
+        if len(requests) >= (throttle.batch_size if throttle else batch_size) \
+                or (checkpoint and processed % batch_size == 0):
+            if requests:
+                started = time.time()
+                collection.bulk_write(requests, ordered=False)
+                requests = []
+                latency = time.time() - started
+                if throttle:
+                    throttle.observe(latency)
+                observe_batch(latency)
+            if checkpoint:
+                checkpoint.save(doc['_id'], resumed + processed)
+            logger.white('%s: %d documents processed' %
+                         (collection.name, processed))
+            progress(resumed + processed, total)
+
+    if requests:
+        started = time.time()
+        collection.bulk_write(requests, ordered=False)
+        observe_batch(time.time() - started)
+    logger.white('%s: %d documents processed' % (collection.name, processed))
+    progress(resumed + processed, total)
+    return processed
+
+
+class PrefixedLogger(object):
+    "Logger adapter which prefixes all messages"
+    def __init__(self, logger, prefix):
+        self._logger = logger
+        self.prefix = prefix
+
+    def __getattr__(self, name):
+        log = getattr(self._logger, name)
+        return lambda msg: log(self.prefix + msg)
+
+    def plain(self, msg):
+        # plain lines are for machines (JSON progress), left unprefixed
+        self._logger.plain(msg)
+
+
+class NullLogger(object):
+    "Logger which drops all messages"
+    def __getattr__(self, name):
+        return lambda msg: None
+
+
+def rewrite_range(args):
+    """Rewrites documents of one _id range for run_partitioned() of
+    migrations manager. Executed in separate process, so it connects with
+    mongo by itself. Returns range, number of processed documents,
+    latencies of batches and formatted exception, if any."""
+    connection, migr, id_range = args
+    processed = 0
+    latencies = BatchLatencies()
+    migr_mod = None
+    try:
+        client = connect(connection['MongoClient'], connection['host'],
+                         connection['port'])
+        db = client[connection['database']]
+        if connection['user'] and connection['password']:
+            db.authenticate(connection['user'], connection['password'])
+
+        migr_mod = load_migration(connection['directory'], migr)
+        query = {}
+        if id_range[0] is None and id_range[1] is not None:
+            # _id of other types than of split points doesn't match any
+            # bound, so the first range takes them
+            query['$not'] = {'$gte': id_range[1]}
+        elif id_range[0] is not None:
+            query['$gte'] = id_range[0]
+            if id_range[1] is not None:
+                query['$lt'] = id_range[1]
+        query = {'_id': query} if query else {}
+        if declared(migr_mod, 'QUERY'):
+            query = {'$and': [declared(migr_mod, 'QUERY'), query]}
+        throttle = False
+        if connection['throttle'] is not None:
+            throttle = Throttle(db, connection['batch_size'],
+                                **connection['throttle'])
+        with recording(latencies, None):
+            processed = rewrite(db[declared(migr_mod, 'COLLECTION')],
+                                declared(migr_mod, 'transform'),
+                                query, declared(migr_mod, 'PROJECTION'),
+                                connection['batch_size'], NullLogger(),
+                                throttle=throttle)
+        return id_range, processed, list(latencies), None
+    except Exception:
+        return id_range, processed, list(latencies), traceback.format_exc()
+    finally:
+        if migr_mod is not None:
+            unload_migration(migr_mod)
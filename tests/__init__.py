@@ -21,6 +21,9 @@ Helpers for testing
 """
 import shutil
 import os
+import pymongo
+import threading
+import time
 
 
 class TestDirectory(object):
@@ -63,13 +66,121 @@ class MigrationsCollectionMock(object):
         migrations = MigrationsCollectionMock(['test1.py', 'test2.py'])
 
         migrations.find_one({'name': 'test1'})
+        migrations.find({'name': {'$in': ['test1', 'test2']}})
+
+    Number of queries sent to the "database" is counted in queries_count
+    attribute.
     """
     def __init__(self, filenames = []):
         self._db = []
+        self.queries_count = 0
         for fname in filenames:
             self._db.append({'name': fname})
 
     def find_one(self, dict_query):
+        self.queries_count += 1
         for row in self._db:
             if dict_query['name'] == row['name']:
-                return row
\ No newline at end of file
+                return row
+
+    def find(self, dict_query, projection=None):
+        self.queries_count += 1
+        names = dict_query['name']['$in']
+        return [dict(row) for row in self._db if row['name'] in names]
+
+
+def bulk_requests(bulk_write_mock):
+    """Returns representations of requests lists given to mocked bulk_write
+    method, one per call (write operations of pymongo 2.x are not
+    comparable)"""
+    return [repr(call[0][0]) for call in bulk_write_mock.call_args_list]
+
+
+def registration_requests(*migr_files):
+    """Returns representation of requests list registering given
+    migrations, comparable with bulk_requests result"""
+    return repr([pymongo.ReplaceOne({'name': migr}, {'name': migr},
+                                    upsert=True) for migr in migr_files])
+
+
+class AsyncClientStandIn(object):
+    """
+    Stand-in of async mongo driver client (like motor). Updates of
+    collections are awaitable and recorded in class attribute updates, as
+    (database, collection, query, update) tuples.
+    """
+    updates = []
+
+    def __init__(self, host, port, **options):
+        self.host = host
+        self.port = port
+        self.closed = False
+
+    def __getitem__(self, database):
+        return AsyncDatabaseStandIn(database)
+
+    def close(self):
+        self.closed = True
+
+
+class AsyncDatabaseStandIn(object):
+    def __init__(self, name):
+        self.name = name
+
+    def __getattr__(self, collection):
+        return AsyncCollectionStandIn(self.name, collection)
+
+
+class AsyncCollectionStandIn(object):
+    def __init__(self, database, name):
+        self.database = database
+        self.name = name
+
+    def update_many(self, query, update):
+        import asyncio
+        AsyncClientStandIn.updates.append((self.database, self.name, query,
+                                           update))
+        # awaitable result, without async syntax unknown to python 2
+        return asyncio.sleep(0, 1)
+
+
+class IndexBuildsStandIn(object):
+    """
+    Stand-in of mongo index builds. Index build started by create_index()
+    of collection (given by create_index(name) as side effect of mock) lasts
+    until it's polled given number of times by currentOp command, which
+    reports its progress.
+    """
+    def __init__(self, database, total=1000, polls=4):
+        self.database = database
+        self.total = total
+        self.polls = polls
+        self.builds = {}
+        self.created = []
+        self.max_concurrent = 0
+        self._lock = threading.Lock()
+
+    def create_index(self, collection):
+        namespace = '%s.%s' % (self.database, collection)
+
+        def create_index(keys, **options):
+            with self._lock:
+                self.builds[namespace] = 0
+                self.max_concurrent = max(self.max_concurrent,
+                                          len(self.builds))
+            while self.builds[namespace] < self.total:
+                time.sleep(0.001)
+            with self._lock:
+                del self.builds[namespace]
+                self.created.append((collection, keys, options))
+        return create_index
+
+    def command(self, name):
+        inprog = []
+        with self._lock:
+            for namespace, done in sorted(self.builds.items()):
+                inprog.append({'opid': namespace, 'ns': namespace,
+                               'progress': {'done': done,
+                                            'total': self.total}})
+                self.builds[namespace] = done + self.total // self.polls
+        return {'inprog': inprog}
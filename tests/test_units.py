@@ -16,12 +16,21 @@
 #You should have received a copy of the GNU Lesser General Public License
 #along with migopy.  If not, see <http://www.gnu.org/licenses/>.
 
+import collections
+import datetime
+import json
 import unittest
 
 import migopy
 import mock
 import os
-from tests import TestDirectory, MigrationsCollectionMock
+import pymongo
+import pymongo.errors
+import sys
+import types
+from tests import TestDirectory, MigrationsCollectionMock, \
+    AsyncClientStandIn, IndexBuildsStandIn, bulk_requests, \
+    registration_requests
 
 
 class MongoMigrationsBehavior(unittest.TestCase):
@@ -33,6 +42,7 @@ class MongoMigrationsBehavior(unittest.TestCase):
         self.MockedMigrationsManager = MockedMigrationsManager
         self.migr_mng = self.MockedMigrationsManager()
         self.migr_mng.collection = mock.Mock()
+        self.migr_mng.collection.find.return_value = []
 
     def test_it_connects_with_mongo(self):
         class Migrations(migopy.MigrationsManager):
@@ -45,20 +55,23 @@ class MongoMigrationsBehavior(unittest.TestCase):
         Migrations()
         self.assertFalse(Migrations.MongoClient.called)
 
-        # when database given
+        # when database given, it connects when collection is used first time
         Migrations.logger.reset_mock()
         Migrations.MongoClient.reset_mock()
         Migrations.MONGO_DATABASE = 'test_db'
-        Migrations()
+        migrations = Migrations()
+        self.assertFalse(Migrations.MongoClient.called)
+        migrations.collection
+        migrations.collection
         Migrations.MongoClient.assert_called_once_with('mongo_host', 11111)
-
+        Migrations.MongoClient().__getitem__.assert_called_once_with('test_db')
 
         # when user and user password given
         Migrations.logger.reset_mock()
         Migrations.MongoClient.reset_mock()
         Migrations.MONGO_USER = 'mongo_user'
         Migrations.MONGO_USER_PASS = 'mongo_user_pass'
-        Migrations()
+        Migrations().db
         Migrations.MongoClient.assert_called_once_with('mongo_host', 11111)
         Migrations.MongoClient().__getitem__().authenticate.\
             assert_called_once_with('mongo_user', 'mongo_user_pass')
@@ -101,6 +114,116 @@ class MongoMigrationsBehavior(unittest.TestCase):
 
             self.assertTrue(cm.exception.message.startswith("Migrations dir"))
 
+    def test_it_keeps_index_of_migrations_in_manifest(self):
+        with TestDirectory() as test_dir:
+            test_dir.mkdir('mongomigrations')
+            test_dir.touch('mongomigrations/__init__.py')
+            test_dir.touch('mongomigrations/2_test.py')
+            test_dir.touch('mongomigrations/1_test.py')
+            self.migr_mng.collection = MigrationsCollectionMock()
+            old_time = os.stat('mongomigrations').st_mtime - 60
+            os.utime('mongomigrations', (old_time, old_time))
+            self.assertEqual(self.migr_mng.unregistered(),
+                             ['1_test.py', '2_test.py'])
+            # manifest is replaced atomically, no temporary files are left
+            self.assertEqual(sorted(os.listdir('.')),
+                             [self.migr_mng.MIGRATIONS_MANIFEST,
+                              'mongomigrations'])
+
+            # when directory not modified, it's not listed again
+            with mock.patch('os.listdir') as listdir_mock:
+                index = self.migr_mng.migrations_index()
+                self.assertFalse(listdir_mock.called)
+            self.assertEqual([(m.number, m.name) for m in index],
+                             [(1, '1_test.py'), (2, '2_test.py')])
+
+            # manifest of other version is not trusted
+            with open(self.migr_mng.MIGRATIONS_MANIFEST) as f:
+                manifest = json.load(f)
+            manifest['version'] = 1
+            with open(self.migr_mng.MIGRATIONS_MANIFEST, 'w') as f:
+                json.dump(manifest, f)
+            self.assertIsNone(self.migr_mng.read_manifest())
+
+            # when directory modified, index is rebuilt
+            test_dir.touch('mongomigrations/3_test.py')
+            self.assertEqual(self.migr_mng.unregistered(),
+                             ['1_test.py', '2_test.py', '3_test.py'])
+
+            # when directory modified just now, manifest is not trusted
+            test_dir.touch('mongomigrations/4_test.py')
+            self.migr_mng.unregistered()
+            with mock.patch('os.listdir', return_value=[]) as listdir_mock:
+                self.migr_mng.migrations_index()
+                self.assertTrue(listdir_mock.called)
+
+    def test_it_checks_registered_migrations_in_batched_queries(self):
+        with TestDirectory() as test_dir:
+            test_dir.mkdir('mongomigrations')
+            for i in range(3000):
+                test_dir.touch('mongomigrations/%d_test.py' % i)
+            self.migr_mng.collection = MigrationsCollectionMock(
+                ['%d_test.py' % i for i in range(0, 3000, 2)])
+            self.migr_mng.show_status()
+            # 1000 names per query
+            self.assertEqual(self.migr_mng.collection.queries_count, 3)
+            self.assertEqual(self.migr_mng.logger.red.call_count, 1500)
+
+            self.migr_mng.collection.queries_count = 0
+            self.migr_mng.REGISTERED_QUERY_BATCH_SIZE = 5000
+            self.migr_mng.show_status()
+            self.assertEqual(self.migr_mng.collection.queries_count, 1)
+
+    def test_it_caches_registrations_by_version(self):
+        with TestDirectory() as test_dir:
+            test_dir.mkdir('mongomigrations')
+            test_dir.touch('mongomigrations/1_test.py')
+            test_dir.touch('mongomigrations/2_test.py')
+            self.migr_mng.REGISTRATIONS_CACHE = '.migopy_registrations'
+            collection = self.migr_mng.collection
+            collection.find_one.return_value = {'version': 3}
+            executed = datetime.datetime(2014, 1, 2, 3, 4, 5)
+            collection.find.return_value = [
+                {'name': '1_test.py', 'execute': {'finished': executed}}]
+            self.assertEqual(self.migr_mng.unregistered(), ['2_test.py'])
+            collection.find_one.assert_called_once_with(
+                {'name': 'migopy:version'}, {'version': True})
+            self.assertEqual(collection.find.call_count, 1)
+
+            # when version not changed, only version is asked
+            registrations = self.migr_mng.registrations(['1_test.py'])
+            self.assertEqual(registrations['1_test.py']['execute'],
+                             {'finished': executed})
+            self.assertEqual(collection.find_one.call_count, 2)
+            self.assertEqual(collection.find.call_count, 1)
+
+            # when version changed, registrations are fetched again
+            collection.find_one.return_value = {'version': 4}
+            collection.find.return_value = [{'name': '1_test.py'},
+                                            {'name': '2_test.py'}]
+            self.assertEqual(self.migr_mng.unregistered(), [])
+            self.assertEqual(collection.find.call_count, 2)
+
+            # failed write leaves neither cache nor temporary file behind
+            files = sorted(os.listdir('.'))
+            with mock.patch('os.rename', side_effect=OSError):
+                self.migr_mng.write_cache(5, {})
+            self.assertEqual(sorted(os.listdir('.')), files)
+
+            # when offline, mongo is not asked at all
+            collection.reset_mock()
+            self.migr_mng.REGISTRATIONS_OFFLINE = True
+            self.migr_mng.show_status()
+            self.assertFalse(collection.find_one.called)
+            self.assertFalse(collection.find.called)
+            self.migr_mng.logger.green.assert_called_once_with(
+                'All migrations registered, nothing to execute')
+
+            # and without cache it's impossible
+            os.remove('.migopy_registrations')
+            with self.assertRaises(migopy.MigopyException):
+                self.migr_mng.show_status()
+
     def test_it_prints_status_of_migrations(self):
         # given test directory
         with TestDirectory() as test_dir:
@@ -123,31 +246,169 @@ class MongoMigrationsBehavior(unittest.TestCase):
                 assert_has_calls([mock.call('1_test.py'),
                                   mock.call('002_test.py')])
 
+    def test_it_loads_migrations_without_keeping_them(self):
+        with TestDirectory() as test_dir:
+            test_dir.mkdir('mongomigrations')
+            test_dir.create_file('mongomigrations/1_test.py',
+                                 'TABLE = list(range(10))\n'
+                                 'def up(db):\n'
+                                 '    return len(TABLE)\n')
+            sys_path = list(sys.path)
+            with migopy.loaded_migration('mongomigrations',
+                                         '1_test.py') as migr_mod:
+                self.assertEqual(migr_mod.up('db'), 10)
+            self.assertEqual(sys.path, sys_path)
+            self.assertFalse([name for name in sys.modules
+                              if name.endswith('1_test')])
+
+            # globals are released after the with block
+            self.assertFalse(hasattr(migr_mod, 'TABLE'))
+
+            # modules of project can be imported while loading
+            test_dir.touch('mongomigrations/__init__.py')
+            test_dir.create_file('mongomigrations/helpers_test.py',
+                                 'SIZE = 3\n')
+            test_dir.create_file('mongomigrations/2_test.py',
+                                 'from mongomigrations import helpers_test\n'
+                                 'def up(db):\n'
+                                 '    return helpers_test.SIZE * 2\n'
+                                 'def down(db):\n    pass\n')
+            self.migr_mng.unregistered = mock.Mock(return_value=['2_test.py'])
+            self.migr_mng.register = mock.Mock()
+            try:
+                self.migr_mng.execute()
+            finally:
+                for name in ['mongomigrations',
+                             'mongomigrations.helpers_test']:
+                    sys.modules.pop(name, None)
+            record = self.migr_mng.register.call_args[0][1]['execute']
+            self.assertEqual(record['docs'], 6)
+            self.assertEqual(sys.path, sys_path)
+
+    def test_it_validates_pending_migrations_before_execution(self):
+        with TestDirectory() as test_dir:
+            test_dir.mkdir('mongomigrations')
+            test_dir.create_file('mongomigrations/1_test.py',
+                                 'def up(db):\n    pass\n'
+                                 'def down(db):\n    pass\n')
+            test_dir.create_file('mongomigrations/2_test.py',
+                                 'def up(db):\n    pass\n'
+                                 'def down(db):\n    pass\n'
+                                 'def transform(doc):\n    pass\n'
+                                 'COLLECTION = "notes"\n'
+                                 'DEPENDS_ON = ["1_test.py"]\n')
+            test_dir.create_file('mongomigrations/6_test.py',
+                                 'def up(db):\n    pass\n'
+                                 'def down(db):\n    pass\n'
+                                 'DEPENDS_ON = ["1_test"]\n')
+            self.migr_mng.unregistered = mock.Mock(return_value=['1_test.py',
+                                                                 '2_test.py',
+                                                                 '6_test.py'])
+            self.migr_mng.check()
+            self.migr_mng.logger.green.assert_called_once_with(
+                'Pending migrations are valid (3 checked)')
+
+            # when some migrations are invalid, all problems are shown
+            test_dir.create_file('mongomigrations/3_test.py',
+                                 'def up(db):\n    pass\n')
+            test_dir.create_file('mongomigrations/4_test.py',
+                                 'def up(:\n')
+            test_dir.create_file('mongomigrations/5_test.py',
+                                 'RESUMABLE = True\n'
+                                 'DEPENDS_ON = "1_test.py"\n'
+                                 'def up(db):\n    pass\n'
+                                 'def down(db, x):\n    pass\n')
+            test_dir.create_file('mongomigrations/7_test.py',
+                                 'PIPELINE = {"notes": [{"$set": {"a": 1}}]}\n'
+                                 'def up(db):\n    pass\n'
+                                 'def down(db):\n    pass\n')
+            self.migr_mng.unregistered.return_value = [
+                '1_test.py', '2_test.py', '3_test.py', '4_test.py',
+                '5_test.py', '7_test.py']
+            self.migr_mng.register = mock.Mock()
+            with self.assertRaises(migopy.MigopyException) as cm:
+                self.migr_mng.execute()
+            self.assertEqual(cm.exception.message,
+                             'Invalid migrations: 3_test.py, 4_test.py, '
+                             '5_test.py, 7_test.py')
+            self.assertFalse(self.migr_mng.register.called)
+            messages = [call[0][0] for call in
+                        self.migr_mng.logger.red.call_args_list]
+            self.assertEqual(messages[0],
+                             '3_test.py - down() function not found')
+            self.assertTrue(messages[1].startswith(
+                '4_test.py - can not be loaded: '))
+            self.assertEqual(messages[2],
+                             '5_test.py - up() should take 2 arguments; '
+                             'down() should take 1 argument; '
+                             'DEPENDS_ON should be list of migrations files '
+                             'names')
+            self.assertEqual(messages[3],
+                             '7_test.py - PIPELINE and up() declared, up() '
+                             'would be ignored')
+
+    @unittest.skipIf(sys.version_info < (3, 5), 'async def not supported')
+    def test_it_executes_async_migrations_on_event_loop(self):
+        with TestDirectory() as test_dir:
+            test_dir.mkdir('mongomigrations')
+            test_dir.create_file(
+                'mongomigrations/1_test.py',
+                'import asyncio\n'
+                'async def up(db):\n'
+                '    results = await asyncio.gather(\n'
+                '        db.notes.update_many({}, {"$set": {"a": 1}}),\n'
+                '        db.users.update_many({}, {"$set": {"b": 1}}))\n'
+                '    return sum(results)\n'
+                'async def down(db):\n'
+                '    await db.notes.update_many({}, {"$unset": {"a": ""}})\n')
+            self.migr_mng.AsyncMongoClient = AsyncClientStandIn
+            self.migr_mng.MONGO_DATABASE = 'test_db'
+            self.migr_mng.unregistered = mock.Mock(return_value=['1_test.py'])
+            self.migr_mng.register = mock.Mock()
+            del AsyncClientStandIn.updates[:]
+            self.migr_mng.execute()
+            self.assertEqual(sorted(AsyncClientStandIn.updates),
+                             [('test_db', 'notes', {}, {'$set': {'a': 1}}),
+                              ('test_db', 'users', {}, {'$set': {'b': 1}})])
+            record = self.migr_mng.register.call_args[0][1]['execute']
+            self.assertEqual(record['docs'], 2)
+
+            # and rollback
+            del AsyncClientStandIn.updates[:]
+            self.migr_mng.rollback('1_test.py')
+            self.assertEqual(AsyncClientStandIn.updates,
+                             [('test_db', 'notes', {},
+                               {'$unset': {'a': ''}})])
+
     def test_it_execute_migrations(self):
-        with mock.patch('importlib.import_module') as im_mock:
+        with mock.patch('migopy.load_migration') as load_mock:
             self.migr_mng.unregistered = mock.Mock(return_value=['1_test.py',
                                                                  '2_test.py'])
             self.migr_mng.db = 'db_object'
+            self.migr_mng.register = mock.Mock()
             self.migr_mng.execute()
             mdir = self.migr_mng.MIGRATIONS_DIRECTORY
-            im_mock.assert_has_calls([mock.call('%s.1_test' % mdir),
+            load_mock.assert_has_calls([mock.call(mdir, '1_test.py'),
                                       mock.call().up('db_object'),
-                                      mock.call('%s.2_test' % mdir),
+                                      mock.call(mdir, '2_test.py'),
                                       mock.call().up('db_object')])
             self.assertEqual(self.migr_mng.logger.white_bold.call_count, 2,
                              "Executions not logged")
 
-            # and register them as executed
-            self.migr_mng.collection.insert \
-                .assert_has_calls([mock.call({'name': '1_test.py'}),
-                                   mock.call({'name': '2_test.py'})])
+            # and register each of them as executed, with execution record
+            self.migr_mng.register.assert_has_calls(
+                [mock.call(['1_test.py'], {'execute': mock.ANY}),
+                 mock.call(['2_test.py'], {'execute': mock.ANY})])
+            record = self.migr_mng.register.call_args[0][1]['execute']
+            self.assertEqual(sorted(record), ['cpu_time', 'finished', 'host',
+                                              'started', 'wall_time'])
 
             # when given specyfic migration, executes only it
-            im_mock.reset_mock()
+            load_mock.reset_mock()
             self.migr_mng.execute('1_test.py')
-            im_mock.assert_has_calls([mock.call('%s.1_test' % mdir),
+            load_mock.assert_has_calls([mock.call(mdir, '1_test.py'),
                                       mock.call().up('db_object')])
-            self.assertEqual(im_mock().up.call_count, 1,
+            self.assertEqual(load_mock().up.call_count, 1,
                              'More migrations executed')
 
             # when given specyfic migration which is not found in unregistered
@@ -158,46 +419,158 @@ class MongoMigrationsBehavior(unittest.TestCase):
         self.migr_mng.unregistered = mock.Mock(return_value=['1_test.py',
                                                              '2_test.py'])
         self.migr_mng.ignore()
-        self.migr_mng.collection.insert\
-            .assert_has_calls([mock.call({'name': '1_test.py'}),
-                               mock.call({'name': '2_test.py'})])
+        self.assertEqual(bulk_requests(self.migr_mng.collection.bulk_write),
+                         [registration_requests('1_test.py', '2_test.py')])
         self.assertEqual(self.migr_mng.logger.white_bold.call_count, 2,
                          "Ignores not logged")
 
         # when given specyfic migration, ignores only it
         self.migr_mng.collection.reset_mock()
         self.migr_mng.ignore('1_test.py')
-        self.migr_mng.collection.insert \
-            .assert_has_calls([mock.call({'name': '1_test.py'})])
-        self.assertEqual(self.migr_mng.collection.insert.call_count, 1,
-                         'More migrations ignored')
+        self.assertEqual(bulk_requests(self.migr_mng.collection.bulk_write),
+                         [registration_requests('1_test.py')])
 
         # when given specyfic migration is not found in unregistered
         with self.assertRaises(migopy.MigopyException):
             self.migr_mng.ignore('3_test.py')
 
+    def test_it_registers_migrations_in_batches(self):
+        self.migr_mng.REGISTER_BATCH_SIZE = 2
+        self.migr_mng.register(['1_test.py', '2_test.py', '3_test.py'])
+        self.migr_mng.collection.create_index.assert_called_once_with(
+            'name', unique=True)
+        self.assertEqual(bulk_requests(self.migr_mng.collection.bulk_write),
+                         [registration_requests('1_test.py', '2_test.py'),
+                          registration_requests('3_test.py')])
+
+        # when some of migrations already registered, skips them
+        self.migr_mng.collection.reset_mock()
+        self.migr_mng.collection.bulk_write.side_effect = \
+            pymongo.errors.BulkWriteError(
+                {'writeErrors': [{'code': 11000}], 'writeConcernErrors': []})
+        self.migr_mng.register(['1_test.py'])
+        self.assertFalse(self.migr_mng.collection.create_index.called,
+                         "Index created more than once")
+
+        # when other errors occurred, raise them
+        self.migr_mng.collection.bulk_write.side_effect = \
+            pymongo.errors.BulkWriteError(
+                {'writeErrors': [{'code': 2}], 'writeConcernErrors': []})
+        with self.assertRaises(pymongo.errors.BulkWriteError):
+            self.migr_mng.register(['1_test.py'])
+
+        # when write concern given, uses it
+        self.migr_mng.collection.reset_mock()
+        self.migr_mng.MIGRATIONS_WRITE_CONCERN = {'w': 'majority'}
+        self.migr_mng.register(['1_test.py'])
+        write_concern = self.migr_mng.collection.with_options.call_args[1]
+        self.assertEqual(write_concern['write_concern'].document,
+                         {'w': 'majority'})
+        self.assertEqual(
+            bulk_requests(self.migr_mng.collection.with_options().bulk_write),
+            [registration_requests('1_test.py')])
+
     def test_it_rollback_migration(self):
-        with mock.patch('importlib.import_module') as im_mock:
+        with mock.patch('migopy.load_migration') as load_mock:
             self.migr_mng.unregistered = mock.Mock(return_value=['1_test.py',
                                                                  '2_test.py'])
             self.migr_mng.db = 'db_object'
             self.migr_mng.rollback('1_test.py')
             mdir = self.migr_mng.MIGRATIONS_DIRECTORY
-            im_mock.assert_has_calls([mock.call('%s.1_test' % mdir),
+            load_mock.assert_has_calls([mock.call(mdir, '1_test.py'),
                                       mock.call().down('db_object')])
-            self.assertEqual(im_mock().down.call_count, 1,
+            self.assertEqual(load_mock().down.call_count, 1,
                              'Executed rollback on more than 1 migrations')
             self.assertEqual(self.migr_mng.logger.white_bold.call_count, 1,
                              "Rollback not logged")
 
-            # and remove migration from register
-            self.migr_mng.collection.remove \
-                .assert_has_calls([mock.call({'name': '1_test.py'})])
+            # and mark migration as not registered, with rollback record
+            unregister_call, version_call = \
+                self.migr_mng.collection.update_one.call_args_list
+            query, update = unregister_call[0]
+            self.assertEqual(query, {'name': '1_test.py'})
+            self.assertEqual(update['$set']['registered'], False)
+            self.assertIn('wall_time', update['$set']['rollback'])
+
+            # and invalidate caches of registrations
+            self.assertEqual(version_call,
+                             mock.call({'name': 'migopy:version'},
+                                       {'$inc': {'version': 1}},
+                                       upsert=True))
 
             # when given specyfic migration is not found in unregistered
             with self.assertRaises(migopy.MigopyException):
                 self.migr_mng.rollback('3_test.py')
 
+    def test_it_fans_out_tasks_to_many_databases(self):
+        class Migrations(self.MockedMigrationsManager):
+            MongoClient = mock.MagicMock()
+            MONGO_DATABASES = ['tenant1', 'tenant2', 'tenant3']
+            FAN_OUT_WORKERS = 2
+
+            def pending(self, offline=False):
+                if self.MONGO_DATABASE == 'tenant3':
+                    raise migopy.MigopyException('Broken tenant')
+                if self.MONGO_DATABASE == 'tenant1':
+                    return [('1_test.py', None)]
+                return []
+
+        dbs = collections.defaultdict(mock.MagicMock)
+        Migrations.MongoClient().__getitem__.side_effect = dbs.__getitem__
+        Migrations.MongoClient.reset_mock()
+        migrations = Migrations()
+        with self.assertRaises(migopy.MigopyException) as cm:
+            migrations.show_status()
+        self.assertEqual(cm.exception.message,
+                         'Failed in 1 of 3 databases: tenant3')
+        # one connection for all databases
+        Migrations.MongoClient.assert_called_once_with('localhost', 27017)
+        # messages of databases are prefixed with their names
+        Migrations.logger.red.assert_any_call('[tenant1] 1_test.py')
+        Migrations.logger.green.assert_any_call(
+            '[tenant2] All migrations registered, nothing to execute')
+        Migrations.logger.green.assert_any_call('tenant1 - done')
+        Migrations.logger.green.assert_any_call('tenant2 - done')
+        Migrations.logger.red.assert_any_call(
+            'tenant3 - failed: Broken tenant')
+
+        # each database has own migrations collection
+        Migrations.MONGO_DATABASES = lambda self: ['tenant1', 'tenant2']
+        migrations.ignore()
+        self.assertEqual(dbs['tenant1']['migrations'].bulk_write.call_count,
+                         1)
+        self.assertFalse(dbs['tenant2']['migrations'].bulk_write.called)
+
+        # abort of database is reported as failure too
+        with mock.patch.object(Migrations, 'check',
+                               side_effect=SystemExit(1)):
+            with self.assertRaises(migopy.MigopyException) as cm:
+                migrations.fan_out('check')
+        self.assertEqual(cm.exception.message,
+                         'Failed in 2 of 2 databases: tenant1, tenant2')
+        Migrations.logger.red.assert_any_call(
+            'tenant1 - failed: aborted (exit code 1)')
+
+        # other tasks are fanned out too
+        with mock.patch('migopy.load_migration') as load_mock:
+            with self.assertRaises(migopy.MigopyException) as cm:
+                migrations.rollback('1_test.py')
+        self.assertEqual(cm.exception.message,
+                         'Failed in 1 of 2 databases: tenant2')
+        load_mock().down.assert_called_once_with(dbs['tenant1'])
+
+        # dumps are kept per database, given one is restored in its database
+        self.assertEqual(migrations.tenant('tenant1').MONGO_DUMP_DIRECTORY,
+                         os.path.join('mongodumps', 'tenant1'))
+        with self.assertRaises(migopy.MigopyException) as cm:
+            migrations.dbrestore('2014_01_14')
+        self.assertIn('database/dump', cm.exception.message)
+        with self.assertRaises(migopy.MigopyException) as cm:
+            migrations.dbrestore('tenant1/2014_01_14')
+        self.assertEqual(cm.exception.message,
+                         'Mongo dump 2014_01_14 not found in '
+                         'mongodumps/tenant1')
+
     def test_it_create_task_for_fabfile(self):
         class Migrations(self.MockedMigrationsManager):
             show_status = mock.Mock()
@@ -277,6 +650,38 @@ class MongoMigrationsBehavior(unittest.TestCase):
         task()
         self.assertFalse(Migrations.show_status.called)
 
+    def test_it_runs_fab_command_on_many_hosts(self):
+        class Migrations(self.MockedMigrationsManager):
+            REMOTE_WORKERS = 2
+
+            @classmethod
+            def remote_command(cls, host, command):
+                # local process instead of ssh
+                return [sys.executable, '-c',
+                        'import sys; print(%r); print(%r); sys.exit(%d)' %
+                        (host, command, 3 if host == 'host3' else 0)]
+
+        with self.assertRaises(migopy.MigopyException) as cm:
+            Migrations.run_on_hosts(['host1', 'host2', 'host3'], 'execute',
+                                    '1_test.py')
+        self.assertEqual(cm.exception.message, 'Failed on 1 of 3 hosts: host3')
+        for host in ['host1', 'host2', 'host3']:
+            Migrations.logger.white.assert_any_call('[%s] %s' % (host, host))
+            Migrations.logger.white.assert_any_call(
+                '[%s] fab migrations:execute,1_test.py' % host)
+        Migrations.logger.green.assert_has_calls([mock.call('host1 - done'),
+                                                  mock.call('host2 - done')])
+        Migrations.logger.red.assert_called_once_with(
+            'host3 - failed (exit code 3)')
+
+        # by default, command is run by ssh
+        Migrations = self.MockedMigrationsManager
+        self.assertEqual(Migrations.remote_command('host1', 'fab migrations'),
+                         ['ssh', 'host1', 'fab migrations'])
+        Migrations.REMOTE_DIRECTORY = '/srv/app'
+        self.assertEqual(Migrations.remote_command('host1', 'fab migrations'),
+                         ['ssh', 'host1', 'cd /srv/app && fab migrations'])
+
     def test_it_logs_errors_as_red_messages(self):
         class Migrations(self.MockedMigrationsManager):
 
@@ -288,6 +693,27 @@ class MongoMigrationsBehavior(unittest.TestCase):
         task()
         Migrations.logger.red.assert_called_once_with("Test message")
 
+    def test_it_registers_tasks_when_class_is_defined(self):
+        class Migrations(self.MockedMigrationsManager):
+            MONGO_DATABASE = 'test_db'
+
+            @migopy.task
+            def task1(self):
+                pass
+
+            def not_task(self):
+                pass
+
+        self.assertIn('task1', Migrations.migopy_tasks)
+        self.assertIn('show_status', Migrations.migopy_tasks)
+        self.assertNotIn('not_task', Migrations.migopy_tasks)
+        self.assertEqual(list(Migrations.migopy_tasks),
+                         sorted(Migrations.migopy_tasks))
+
+        # help doesn't connect with mongo
+        Migrations.create_task()('help')
+        self.assertFalse(Migrations.MongoClient.called)
+
     def test_it_shows_help_for_each_migopy_task(self):
         mock_attr = mock.MagicMock()
         mock_attr.__name__ = 'name'
@@ -343,9 +769,9 @@ class MongoMigrationsBehavior(unittest.TestCase):
                              "Mongo dump not logged")
 
     def test_it_optionaly_do_mongodump_before_execution(self):
-        with mock.patch('importlib.import_module'):
+        with mock.patch('migopy.load_migration'):
             self.migr_mng.unregistered = mock.Mock(return_value=['1_test.py'])
-            self.migr_mng.dbdump = mock.Mock()
+            self.migr_mng.dbdump = mock.Mock(return_value={'duration': 1.0})
             self.migr_mng.execute()
             self.assertFalse(self.migr_mng.dbdump.called)
             self.migr_mng.DO_MONGO_DUMP = True
@@ -362,3 +788,871 @@ class MongoMigrationsBehavior(unittest.TestCase):
         self.assertEqual(self.MockedMigrationsManager.
                          fab_command('task1', 'option1'),
                          "fab migrations:task1,option1")
+
+    def test_it_rewrites_documents_in_bulk_batches(self):
+        collection = mock.Mock()
+        collection.name = 'notes'
+        collection.find.return_value = iter([{'_id': i, 'x': i}
+                                             for i in range(5)])
+
+        def update(doc):
+            if doc['x'] == 3:
+                return None
+            return {'$set': {'y': doc['x']}}
+
+        processed = migopy.rewrite(collection, update, {'x': {'$gte': 0}},
+                                   {'x': True}, batch_size=2,
+                                   logger=self.migr_mng.logger)
+        self.assertEqual(processed, 5)
+        collection.find.assert_called_once_with({'x': {'$gte': 0}},
+                                                {'x': True}, batch_size=2)
+        batches = [repr(call[0][0]) for call in
+                   collection.bulk_write.call_args_list]
+        self.assertEqual(batches, [
+            repr([pymongo.UpdateOne({'_id': 0}, {'$set': {'y': 0}}),
+                  pymongo.UpdateOne({'_id': 1}, {'$set': {'y': 1}})]),
+            repr([pymongo.UpdateOne({'_id': 2}, {'$set': {'y': 2}}),
+                  pymongo.UpdateOne({'_id': 4}, {'$set': {'y': 4}})])])
+        self.assertEqual(self.migr_mng.logger.white.call_count, 3,
+                         "Progress not logged")
+
+        # when last batch is not full, it's flushed too
+        collection.reset_mock()
+        collection.find.return_value = iter([{'_id': 0, 'x': 0}])
+        migopy.rewrite(collection, lambda doc: pymongo.DeleteOne(doc),
+                       logger=self.migr_mng.logger)
+        self.assertEqual(collection.bulk_write.call_count, 1)
+        self.assertEqual(repr(collection.bulk_write.call_args[0][0]),
+                         repr([pymongo.DeleteOne({'_id': 0, 'x': 0})]))
+
+        # called by migration, it logs to logger of its migrations manager
+        logger = mock.Mock()
+        tenant = migopy.PrefixedLogger(logger, '[customer_1] ')
+        collection.find.return_value = iter([{'_id': 0, 'x': 0}])
+        self.migr_mng.logger = tenant
+        self.migr_mng.call(lambda db: migopy.rewrite(collection,
+                                                     lambda doc: None))
+        logger.white.assert_called_with(
+            '[customer_1] notes: 1 documents processed')
+        self.assertIsNone(getattr(migopy._reporters, 'logger', None))
+
+    def test_it_resumes_migrations_from_checkpoint(self):
+        with TestDirectory() as test_dir:
+            test_dir.mkdir('mongomigrations')
+            test_dir.touch('mongomigrations/1_test.py')
+            test_dir.touch('mongomigrations/2_test.py')
+            self.migr_mng.collection = MigrationsCollectionMock()
+            self.migr_mng.collection._db.append(
+                {'name': '1_test.py', 'registered': False,
+                 'checkpoint': 10, 'processed': 11})
+
+            # when migration partially applied, it's still unregistered
+            self.assertEqual(self.migr_mng.unregistered(),
+                             ['1_test.py', '2_test.py'])
+            self.migr_mng.show_status()
+            self.assertTrue(self.migr_mng.logger.red.call_args_list[0][0][0]
+                            .startswith('1_test.py - partially applied, 11'))
+            self.migr_mng.logger.red.assert_called_with('2_test.py')
+
+            checkpoint = self.migr_mng.checkpoint('1_test.py')
+            self.assertEqual((checkpoint.value, checkpoint.processed),
+                             (10, 11))
+            checkpoint = self.migr_mng.checkpoint('2_test.py')
+            self.assertEqual((checkpoint.value, checkpoint.processed),
+                             (None, 0))
+
+        # resumable migrations get checkpoint
+        migr_mod = mock.Mock()
+        self.migr_mng.db = 'db_object'
+        self.migr_mng.checkpoint = mock.Mock(return_value='checkpoint')
+        self.migr_mng.run_up('1_test.py', migr_mod)
+        migr_mod.up.assert_called_once_with('db_object')
+        migr_mod.reset_mock()
+        migr_mod.RESUMABLE = True
+        self.migr_mng.run_up('1_test.py', migr_mod)
+        migr_mod.up.assert_called_once_with('db_object', 'checkpoint')
+
+    def test_it_rewrites_documents_from_checkpoint(self):
+        collection = mock.Mock()
+        collection.find.return_value = iter([{'_id': i} for i in range(11, 16)])
+        checkpoint = migopy.Checkpoint(collection, '1_test.py', 10, 11)
+        processed = migopy.rewrite(collection, lambda doc: None,
+                                   {'x': 1}, batch_size=2,
+                                   logger=self.migr_mng.logger,
+                                   checkpoint=checkpoint)
+        self.assertEqual(processed, 5)
+        collection.find.assert_called_once_with(
+            {'$and': [{'x': 1}, {'_id': {'$gt': 10}}]}, None, batch_size=2,
+            sort=[('_id', pymongo.ASCENDING)])
+        self.assertFalse(collection.bulk_write.called)
+        # checkpoint saved after each batch
+        self.assertEqual(collection.update_one.call_count, 2)
+        update = collection.update_one.call_args[0]
+        self.assertEqual(update[0], {'name': '1_test.py'})
+        self.assertEqual(update[1]['$set']['checkpoint'], 14)
+        self.assertEqual(update[1]['$set']['processed'], 15)
+        self.assertEqual(update[1]['$set']['registered'], False)
+        self.assertEqual((checkpoint.value, checkpoint.processed), (14, 15))
+
+    def test_it_executes_migrations_by_ranges_in_parallel(self):
+        collection = mock.Mock()
+        collection.aggregate.return_value = iter([{'_id': i}
+                                                  for i in range(8, 0, -1)])
+        self.assertEqual(self.migr_mng.split_ranges(collection, 4),
+                         [(None, 3), (3, 5), (5, 7), (7, None)])
+        self.assertEqual(
+            collection.aggregate.call_args[0][0][0]['$sample']['size'],
+            4 * self.migr_mng.PARALLEL_SAMPLES)
+        # _id of mixed types can't be compared by ranges
+        collection.aggregate.return_value = iter(
+            [{'_id': 'a'}, {'_id': 2}, {'_id': 3.5}, {'_id': 'b'}])
+        self.assertEqual(self.migr_mng.split_ranges(collection, 4),
+                         [(None, None)])
+
+        # migration declaring collection and transform is executed in ranges
+        class Pool(object):
+            def imap_unordered(self, func, iterable):
+                return [func(args) for args in iterable]
+
+            def close(self):
+                pass
+
+            def join(self):
+                pass
+
+        migr_mod = types.ModuleType('7_partitioned')
+        migr_mod.COLLECTION = 'notes'
+        migr_mod.transform = lambda doc: {'$set': {'y': 1 / doc['x']}}
+        self.migr_mng.MongoClient = mock.MagicMock()
+        db = self.migr_mng.MongoClient()['db']
+        db['notes'].find.side_effect = \
+            lambda query, *args, **kwargs: [{'_id': 1, 'x': 1}]
+        self.migr_mng.db = db
+        self.migr_mng.PARALLEL_WORKERS = 2
+        self.migr_mng.split_ranges = mock.Mock(return_value=[(None, 5),
+                                                             (5, None)])
+        self.migr_mng.partition_pool = mock.Mock(return_value=Pool())
+        metrics = mock.Mock()
+        with mock.patch('migopy.load_migration', return_value=migr_mod):
+            with migopy.recording(metrics, {'migration': '7_partitioned.py'}):
+                self.assertEqual(self.migr_mng.run_up('7_partitioned.py',
+                                                      migr_mod), 2)
+        # latencies of batches are observed by parent process
+        self.assertEqual(metrics.record.call_count, 2)
+        metrics.record.assert_called_with(
+            'migopy_batch_latency_seconds', mock.ANY,
+            {'migration': '7_partitioned.py'}, 'histogram')
+        self.migr_mng.split_ranges.assert_called_once_with(
+            db['notes'], 2 * self.migr_mng.PARALLEL_RANGES_PER_WORKER)
+        self.assertEqual([call[0][0] for call in
+                          db['notes'].find.call_args_list],
+                         [{'_id': {'$not': {'$gte': 5}}},
+                          {'_id': {'$gte': 5}}])
+        self.assertEqual(db['notes'].bulk_write.call_count, 2)
+        self.assertEqual(self.migr_mng.logger.white.call_count, 2)
+
+        # workers forget reporter and sink forked from parent process
+        with mock.patch('multiprocessing.Pool') as pool_mock:
+            self.migr_mng.__class__.partition_pool(self.migr_mng, 2)
+        pool_mock.assert_called_once_with(
+            2, initializer=migopy.forget_reporters)
+        with migopy.reporting(mock.Mock()), migopy.recording(metrics, {}):
+            migopy.forget_reporters()
+            self.assertIsNone(migopy.progress_reporter())
+            migopy.observe_batch(0.1)
+        self.assertEqual(metrics.record.call_count, 2)
+
+        # when some ranges fails, reports them
+        db['notes'].find.side_effect = \
+            lambda query, *args, **kwargs: [{'_id': 1, 'x': 0}]
+        with mock.patch('migopy.load_migration', return_value=migr_mod):
+            with self.assertRaises(migopy.MigopyException) as cm:
+                self.migr_mng.run_up('7_partitioned.py', migr_mod)
+        self.assertIn('failed in 2 of 2 ranges', cm.exception.message)
+        self.assertEqual(self.migr_mng.logger.red.call_count, 2)
+        self.assertIn('ZeroDivisionError',
+                      self.migr_mng.logger.red.call_args[0][0])
+
+    def test_it_schedules_independent_migrations_concurrently(self):
+        def module(name, **attrs):
+            migr_mod = types.ModuleType(name)
+            for attr, value in attrs.items():
+                setattr(migr_mod, attr, value)
+            return migr_mod
+
+        migr_mods = [('1_a.py', module('1_a', COLLECTIONS=['a'])),
+                     ('2_b.py', module('2_b', COLLECTIONS=['b'])),
+                     ('3_a.py', module('3_a', COLLECTION='a')),
+                     ('4_c.py', module('4_c', DEPENDS_ON=['2_b'])),
+                     ('5_x.py', module('5_x')),
+                     ('6_c.py', module('6_c', COLLECTIONS=['c']))]
+        self.migr_mng.collection = MigrationsCollectionMock()
+        self.assertEqual(self.migr_mng.dependencies(migr_mods),
+                         {'1_a.py': set(),
+                          '2_b.py': set(),
+                          '3_a.py': set(['1_a.py']),
+                          '4_c.py': set(['2_b.py']),
+                          '5_x.py': set(['1_a.py', '2_b.py', '3_a.py',
+                                         '4_c.py']),
+                          '6_c.py': set(['5_x.py'])})
+
+        # when dependency is not found, raise exception
+        migr_mods.append(('7_d.py', module('7_d', DEPENDS_ON=['0_d.py'])))
+        with self.assertRaises(migopy.MigopyException):
+            self.migr_mng.dependencies(migr_mods)
+        self.migr_mng.collection = MigrationsCollectionMock(['0_d.py'])
+        self.assertEqual(self.migr_mng.dependencies(migr_mods)['7_d.py'],
+                         set(['5_x.py']))
+
+        # migrations are executed in order of dependencies
+        executed = []
+        migr_mods = dict(migr_mods)
+        for migr, migr_mod in migr_mods.items():
+            migr_mod.up = lambda db, migr=migr: executed.append(migr)
+        self.migr_mng.collection = mock.Mock()
+        self.migr_mng.EXECUTE_WORKERS = 3
+        self.migr_mng.registered = mock.Mock(return_value=set(['0_d.py']))
+        with mock.patch('migopy.load_migration',
+                        side_effect=lambda directory, migr: migr_mods[migr]):
+            self.migr_mng.run_scheduled(sorted(migr_mods))
+        self.assertEqual(sorted(executed), sorted(migr_mods))
+        self.assertTrue(executed.index('1_a.py') < executed.index('3_a.py'))
+        self.assertTrue(executed.index('2_b.py') < executed.index('4_c.py'))
+        self.assertEqual(executed.index('5_x.py'), 4)
+        self.assertEqual(self.migr_mng.collection.bulk_write.call_count, 7,
+                         "Not all migrations registered")
+
+        # when migration fails, not started migrations are not executed
+        del executed[:]
+        self.migr_mng.collection.reset_mock()
+        migr_mods['2_b.py'].up = lambda db: 1 / 0
+        with mock.patch('migopy.load_migration',
+                        side_effect=lambda directory, migr: migr_mods[migr]):
+            with self.assertRaises(migopy.MigopyException) as cm:
+                self.migr_mng.run_scheduled(sorted(migr_mods))
+        self.assertIn('2_b.py', cm.exception.message)
+        self.assertNotIn('4_c.py', executed)
+        self.assertNotIn('5_x.py', executed)
+        self.assertEqual(self.migr_mng.collection.bulk_write.call_count,
+                         len(executed))
+
+    def test_it_throttles_batches_by_replication_lag_and_latency(self):
+        lags = [0, 0, 30, 20, 0, 0]
+        sleep = mock.Mock()
+        throttle = migopy.Throttle(None, batch_size=100, min_batch_size=10,
+                                   max_lag=10, max_latency=1.0,
+                                   check_interval=0, sleep=sleep,
+                                   lag_func=lambda: lags.pop(0))
+        throttle.observe(0.1)
+        self.assertEqual(throttle.batch_size, 100)
+
+        # when batch is slow, shrinks batches
+        throttle.observe(2.0)
+        self.assertEqual(throttle.batch_size, 50)
+
+        # when secondaries lag, shrinks batches and pauses until they catch up
+        throttle.observe(0.1)
+        self.assertEqual(throttle.batch_size, 12)
+        self.assertEqual(sleep.call_count, 2)
+
+        # when cluster is healthy again, grows batches
+        throttle.observe(0.1)
+        self.assertEqual(throttle.batch_size, 19)
+        for i in range(10):
+            throttle.lag_func = lambda: 0
+            throttle.observe(0.1)
+        self.assertEqual(throttle.batch_size, 100)
+
+        # lag of the slowest secondary is taken from replica set status
+        now = datetime.datetime.now()
+        db = mock.MagicMock()
+        db.client.admin.command.return_value = {'members': [
+            {'stateStr': 'SECONDARY',
+             'optimeDate': now - datetime.timedelta(seconds=3)},
+            {'stateStr': 'PRIMARY', 'optimeDate': now},
+            {'stateStr': 'SECONDARY',
+             'optimeDate': now - datetime.timedelta(seconds=7)}]}
+        self.assertEqual(migopy.replication_lag(db), 7)
+        db.client.admin.command.side_effect = \
+            pymongo.errors.OperationFailure('not running with --replSet')
+        self.assertEqual(migopy.replication_lag(db), 0)
+
+        # throttled rewrite sends batches of size given by throttle
+        collection = mock.Mock()
+        collection.find.return_value = iter([{'_id': i} for i in range(10)])
+        throttle = mock.Mock(batch_size=4)
+        migopy.rewrite(collection, lambda doc: {'$set': {'x': 1}},
+                       logger=self.migr_mng.logger, throttle=throttle)
+        self.assertEqual([len(call[0][0]) for call in
+                          collection.bulk_write.call_args_list], [4, 4, 2])
+        self.assertEqual(throttle.observe.call_count, 2)
+
+        # throttle is configured by migrations manager attributes
+        self.assertEqual(self.migr_mng.throttle(100), None)
+        self.migr_mng.THROTTLE = True
+        self.migr_mng.THROTTLE_MAX_LAG = 3
+        throttle = self.migr_mng.throttle(100, db)
+        self.assertEqual((throttle.batch_size, throttle.max_lag), (100, 3))
+
+        # and used by rewrite() called by executed migration
+        collection.find.return_value = iter([{'_id': i} for i in range(10)])
+        with mock.patch('migopy.Throttle') as throttle_mock:
+            throttle_mock.return_value.batch_size = 5
+            self.migr_mng.call(lambda db: migopy.rewrite(
+                collection, lambda doc: {'$set': {'x': 1}}, batch_size=5,
+                logger=self.migr_mng.logger))
+            throttle_mock.assert_called_once_with(
+                collection.database, 5,
+                **self.migr_mng.throttle_options())
+            self.assertTrue(throttle_mock.return_value.observe.called)
+            # unless it's turned off or nothing is executed
+            self.migr_mng.call(lambda db: migopy.rewrite(
+                collection, lambda doc: None, logger=self.migr_mng.logger,
+                throttle=False))
+            migopy.rewrite(collection, lambda doc: None,
+                           logger=self.migr_mng.logger)
+            self.assertEqual(throttle_mock.call_count, 1)
+
+    def test_it_records_and_shows_statistics_of_migrations(self):
+        result, record = self.migr_mng.measure(lambda x: x, 10)
+        self.assertEqual(result, 10)
+        self.assertEqual(record['docs'], 10)
+        self.assertTrue(record['started'] <= record['finished'])
+        result, record = self.migr_mng.measure(lambda: {'a': 1, 'b': 2})
+        self.assertEqual((record['docs'], record['counts']),
+                         (3, {'a': 1, 'b': 2}))
+        result, record = self.migr_mng.measure(lambda: None)
+        self.assertNotIn('docs', record)
+
+        # the slowest migrations
+        now = datetime.datetime.utcnow()
+        record = {'started': now, 'finished': now, 'wall_time': 20.0,
+                  'cpu_time': 5.0, 'host': 'host1', 'docs': 1000}
+        self.migr_mng.collection.find.return_value = [
+            {'name': '1_test.py', 'execute': record}]
+        self.migr_mng.stats()
+        self.assertEqual(self.migr_mng.collection.find.call_args[1]['sort'],
+                         [('execute.wall_time', pymongo.DESCENDING)])
+        self.migr_mng.logger.white.assert_called_once_with(
+            '1_test.py: 20.0s (CPU 5.0s), 1000 documents, 50 documents/s, '
+            'on host1 at %s' % now)
+
+        # comparison of migration between environments
+        self.migr_mng.logger.reset_mock()
+        self.migr_mng.ENVIRONMENT = 'staging'
+        self.migr_mng.STATS_ENVIRONMENTS = {'production': 'mongodb://prod/db'}
+        self.migr_mng.MongoClient = mock.MagicMock()
+        self.migr_mng.collection.find_one.return_value = {'execute': record}
+        self.migr_mng.stats('1_test.py')
+        self.migr_mng.MongoClient.assert_called_once_with('mongodb://prod/db')
+        self.assertTrue(self.migr_mng.logger.white.call_args[0][0]
+                        .startswith('staging: 20.0s'))
+        self.migr_mng.logger.red.assert_called_once_with(
+            'production: not executed')
+        # connections with other environments are closed
+        self.migr_mng.MongoClient().close.assert_called_once_with()
+
+        # URI without database is reported
+        self.migr_mng.MongoClient().get_default_database.side_effect = \
+            pymongo.errors.ConfigurationError('No default database defined')
+        with self.assertRaises(migopy.MigopyException) as cm:
+            self.migr_mng.stats('1_test.py')
+        self.assertEqual(cm.exception.message,
+                         'Can not connect with production environment (URI '
+                         'with database name required): No default database '
+                         'defined')
+        self.assertEqual(self.migr_mng.MongoClient().close.call_count, 2)
+
+    def test_it_executes_pipeline_migrations_on_server(self):
+        migr_mod = types.ModuleType('1_test')
+        migr_mod.PIPELINE = {
+            'notes': [{'$set': {'title': {'$toUpper': '$name'}}},
+                      {'$unset': 'name'}],
+            'users': [{'$lookup': {'from': 'groups', 'localField': 'group',
+                                   'foreignField': '_id', 'as': 'groups'}}]}
+        migr_mod.DOWN_PIPELINE = {
+            'notes': [{'$set': {'name': '$title'}}, {'$unset': 'title'}]}
+        dbs = collections.defaultdict(mock.MagicMock)
+        self.migr_mng.db = mock.MagicMock()
+        self.migr_mng.db.__getitem__.side_effect = dbs.__getitem__
+        dbs['notes'].update_many.return_value.modified_count = 5
+        self.migr_mng.unregistered = mock.Mock(return_value=['1_test.py'])
+        self.migr_mng.register = mock.Mock()
+        with mock.patch('migopy.load_migration', return_value=migr_mod):
+            self.migr_mng.execute()
+
+        # stages allowed in updates are applied by update
+        dbs['notes'].update_many.assert_called_once_with(
+            {}, migr_mod.PIPELINE['notes'])
+        # other ones by merging results into the collection
+        dbs['users'].aggregate.assert_called_once_with(
+            migr_mod.PIPELINE['users'] +
+            [{'$merge': {'into': 'users', 'on': '_id',
+                         'whenMatched': 'replace',
+                         'whenNotMatched': 'discard'}}])
+        self.assertFalse(dbs['notes'].find.called)
+        self.assertFalse(dbs['users'].find.called)
+        record = self.migr_mng.register.call_args[0][1]['execute']
+        self.assertEqual(record['counts'], {'notes': 5})
+        self.assertEqual(migopy.migration_collections(migr_mod),
+                         ['notes', 'users'])
+
+        # rollback applies DOWN_PIPELINE
+        dbs['notes'].reset_mock()
+        with mock.patch('migopy.load_migration', return_value=migr_mod):
+            self.migr_mng.rollback('1_test.py')
+        dbs['notes'].update_many.assert_called_once_with(
+            {}, migr_mod.DOWN_PIPELINE['notes'])
+
+    def test_it_applies_operations_yielded_by_migration(self):
+        dbs = collections.defaultdict(mock.MagicMock)
+        self.migr_mng.db = mock.MagicMock()
+        self.migr_mng.db.__getitem__.side_effect = dbs.__getitem__
+        self.migr_mng.GENERATOR_BATCH_SIZE = 2
+        written = []
+
+        def up(db):
+            for i in range(3):
+                written.append(dbs['notes'].bulk_write.call_count)
+                yield 'notes', pymongo.InsertOne({'_id': i})
+            yield 'users', pymongo.DeleteOne({'_id': 1})
+            yield 'notes', migopy.CreateIndex([('title', 1)], unique=True)
+            yield 'notes', pymongo.UpdateOne({'_id': 1}, {'$set': {'a': 1}})
+
+        migr_mod = types.ModuleType('1_test')
+        migr_mod.up = up
+        counts = self.migr_mng.run_up('1_test.py', migr_mod)
+        self.assertEqual(counts, {'notes': 4, 'users': 1})
+        # consecutive operations of collection in batches
+        self.assertEqual(bulk_requests(dbs['notes'].bulk_write), [
+            repr([pymongo.InsertOne({'_id': 0}),
+                  pymongo.InsertOne({'_id': 1})]),
+            repr([pymongo.InsertOne({'_id': 2})]),
+            repr([pymongo.UpdateOne({'_id': 1}, {'$set': {'a': 1}})])])
+        self.assertEqual(bulk_requests(dbs['users'].bulk_write),
+                         [repr([pymongo.DeleteOne({'_id': 1})])])
+        dbs['notes'].create_index.assert_called_once_with(
+            [('title', 1)], unique=True, background=True)
+        dbs['notes'].bulk_write.assert_called_with(mock.ANY, ordered=True)
+        # generator is consumed lazily, batch by batch
+        self.assertEqual(written, [0, 0, 1])
+
+        # interleaved operations of collections are batched too
+        def up(db):
+            for i in range(10):
+                yield 'archive', pymongo.InsertOne({'_id': i})
+                yield 'notes', pymongo.DeleteOne({'_id': i})
+
+        migr_mod.up = up
+        dbs.clear()
+        self.migr_mng.GENERATOR_BATCH_SIZE = 4
+        counts = self.migr_mng.run_up('1_test.py', migr_mod)
+        self.assertEqual(counts, {'archive': 10, 'notes': 10})
+        self.assertEqual(dbs['archive'].bulk_write.call_count, 3)
+        self.assertEqual(dbs['notes'].bulk_write.call_count, 3)
+
+    def test_it_builds_declared_indexes_concurrently(self):
+        builds = IndexBuildsStandIn('test_db')
+        dbs = collections.defaultdict(mock.MagicMock)
+        self.migr_mng.db = mock.MagicMock()
+        self.migr_mng.db.name = 'test_db'
+        self.migr_mng.db.__getitem__.side_effect = dbs.__getitem__
+        self.migr_mng.db.client.admin.command.side_effect = builds.command
+        for name in ['notes', 'users']:
+            dbs[name].create_index.side_effect = builds.create_index(name)
+        self.migr_mng.INDEX_POLL_INTERVAL = 0.001
+        migr_mod = types.ModuleType('1_test')
+        migr_mod.INDEXES = {
+            'notes': [migopy.CreateIndex([('title', 1)], unique=True),
+                      'created'],
+            'users': [[('email', 1)]]}
+        dbs['notes'].index_information.return_value = {
+            '_id_': {'key': [('_id', 1)]},
+            'created_1': {'key': [('created', 1)]}}
+        created = []
+        self.migr_mng.run_up('1_test.py', migr_mod, created)
+        # in background by default
+        self.assertEqual(sorted(builds.created),
+                         [('notes', [('title', 1)],
+                           {'unique': True, 'background': True}),
+                          ('users', [('email', 1)], {'background': True})])
+        self.assertEqual(sorted(created), [['notes', 'title_1'],
+                                           ['users', 'email_1']])
+        self.assertEqual(builds.max_concurrent, 2)
+        messages = [call[0][0] for call in
+                    self.migr_mng.logger.white.call_args_list]
+        # existing indexes are skipped
+        self.assertIn('notes: index created_1 already exists', messages)
+        # progress of builds is reported
+        self.assertIn('test_db.notes: index build 0% (0 of 1000), '
+                      'ETA unknown', messages)
+        self.assertTrue([message for message in messages if
+                         message.startswith('test_db.users: index build 50% '
+                                            '(500 of 1000), ETA ')])
+
+        # rollback drops indexes created by migration, which still exist,
+        # ones existing before are kept
+        dbs['notes'].index_information.return_value['title_1'] = {
+            'key': [('title', 1)], 'unique': True}
+        self.migr_mng.run_down(migr_mod, created)
+        dbs['notes'].drop_index.assert_called_once_with('title_1')
+        self.assertFalse(dbs['users'].drop_index.called)
+
+    def test_it_reports_progress_of_migration(self):
+        now = [100.0]
+        logger = mock.Mock()
+        progress = migopy.Progress('1_test.py', logger, interval=5,
+                                   clock=lambda: now[0])
+        # reports are rate limited
+        progress.update(10, 1000)
+        now[0] += 4
+        progress.update(40)
+        self.assertFalse(logger.white.called)
+        now[0] += 6
+        progress.update(100)
+        logger.white.assert_called_once_with(
+            '1_test.py: 100 of 1000 (10%) documents, 10.0 docs/s, '
+            'elapsed 0:00:10, ETA 0:01:30')
+        progress.finish()
+        self.assertEqual(logger.white.call_count, 2)
+
+        # and can be given as JSON lines
+        progress = migopy.Progress('1_test.py', logger, interval=5,
+                                   format='json', clock=lambda: now[0])
+        now[0] += 20
+        progress.update(40)
+        logger.plain.assert_called_once_with(
+            '{"database": null, "done": 40, "elapsed": 20.0, "eta": null, '
+            '"migration": "1_test.py", "rate": 2.0, "total": null}')
+
+        # which stay valid JSON in tenant's prefixed log
+        logger.reset_mock()
+        progress = migopy.Progress(
+            '1_test.py', migopy.PrefixedLogger(logger, '[customer_1] '),
+            interval=5, format='json', clock=lambda: now[0],
+            database='customer_1')
+        now[0] += 20
+        progress.update(40)
+        line = logger.plain.call_args[0][0]
+        self.assertEqual(json.loads(line)['database'], 'customer_1')
+
+    def test_it_routes_progress_to_executed_migration(self):
+        migr_mod = types.ModuleType('1_test')
+        migr_mod.up = lambda db: [migopy.progress(done, 3)
+                                  for done in range(1, 4)]
+        migr_mod.down = lambda db: None
+        self.migr_mng.unregistered = mock.Mock(return_value=['1_test.py'])
+        self.migr_mng.register = mock.Mock()
+        self.migr_mng.PROGRESS_INTERVAL = 0
+        with mock.patch('migopy.load_migration', return_value=migr_mod):
+            self.migr_mng.execute()
+        messages = [call[0][0] for call in
+                    self.migr_mng.logger.white.call_args_list]
+        self.assertEqual(len(messages), 4)
+        self.assertTrue(messages[0].startswith(
+            '1_test.py: 1 of 3 (33%) documents'))
+        self.assertTrue(messages[-1].startswith(
+            '1_test.py: 3 of 3 (100%) documents'))
+
+        # outside of executed migration, it does nothing
+        self.assertIsNone(migopy.progress_reporter())
+        migopy.progress(1, 3)
+
+    def test_it_exports_metrics_of_executed_migrations(self):
+        migr_mod = types.ModuleType('1_test')
+        migr_mod.up = lambda db: [migopy.observe_batch(latency)
+                                  for latency in (0.02, 0.2, 20)] and 5
+        migr_mod.down = lambda db: None
+        self.migr_mng.unregistered = mock.Mock(return_value=['1_test.py'])
+        self.migr_mng.register = mock.Mock()
+        self.migr_mng.MongoClient = mock.MagicMock()
+        self.migr_mng.MONGO_DATABASE = 'notes_db'
+        with TestDirectory():
+            self.migr_mng.METRICS = migopy.PrometheusTextfile('migopy.prom')
+            with mock.patch('migopy.load_migration', return_value=migr_mod):
+                self.migr_mng.execute()
+            with open('migopy.prom') as f:
+                lines = f.read().splitlines()
+        labels = 'database="notes_db",migration="1_test.py"'
+        self.assertIn('migopy_migration_documents{%s} 5' % labels, lines)
+        self.assertIn('# TYPE migopy_batch_latency_seconds histogram', lines)
+        self.assertIn('migopy_batch_latency_seconds_bucket{%s,le="0.05"} 1' %
+                      labels, lines)
+        self.assertIn('migopy_batch_latency_seconds_bucket{%s,le="10"} 2' %
+                      labels, lines)
+        self.assertIn('migopy_batch_latency_seconds_bucket{%s,le="+Inf"} 3' %
+                      labels, lines)
+        self.assertIn('migopy_run_regressions{database="notes_db"} 0', lines)
+        self.assertTrue(any(line.startswith(
+            'migopy_migration_duration_seconds{%s} ' % labels)
+            for line in lines))
+
+        # or as JSON lines
+        with TestDirectory():
+            metrics = migopy.JsonLinesMetrics('migopy.jsonl')
+            metrics.record('migopy_pending_migrations', 2, {'database': 'a'})
+            metrics.flush()
+            with open('migopy.jsonl') as f:
+                record = json.loads(f.read())
+        self.assertEqual(record['name'], 'migopy_pending_migrations')
+        self.assertEqual(record['value'], 2)
+        self.assertEqual(record['labels'], {'database': 'a'})
+
+    def test_it_keeps_exception_of_migration_when_metrics_fail(self):
+        migr_mod = types.ModuleType('1_test')
+        migr_mod.up = lambda db: 1 / 0
+        migr_mod.down = lambda db: None
+        self.migr_mng.unregistered = mock.Mock(return_value=['1_test.py'])
+        self.migr_mng.METRICS = mock.Mock()
+        self.migr_mng.METRICS.flush.side_effect = IOError('Permission denied')
+        with mock.patch('migopy.load_migration', return_value=migr_mod):
+            with self.assertRaises(ZeroDivisionError):
+                self.migr_mng.execute()
+        message = self.migr_mng.logger.red.call_args[0][0]
+        self.assertTrue(message.startswith('Summary of run not saved:'))
+        self.assertIn('Permission denied', message)
+
+    def test_it_flags_regressions_against_previous_runs(self):
+        migr_mod = types.ModuleType('1_test')
+        migr_mod.up = lambda db: 100
+        migr_mod.down = lambda db: None
+        self.migr_mng.unregistered = mock.Mock(return_value=['1_test.py'])
+        self.migr_mng.register = mock.Mock()
+        self.migr_mng.collection.find.return_value = [
+            {'throughput': 1e12, 'dump_duration': None,
+             'migrations': [{'name': '1_test.py', 'wall_time': 1e-9,
+                             'docs': 100},
+                            {'name': '2_test.py', 'wall_time': 1e-9,
+                             'docs': None}]}]
+        with mock.patch('migopy.load_migration', return_value=migr_mod):
+            self.migr_mng.execute()
+        query = self.migr_mng.collection.find.call_args[0][0]
+        self.assertEqual(query, {'name': {'$regex': '^migopy:run:'},
+                                 'failed': False})
+        run = self.migr_mng.collection.insert_one.call_args[0][0]
+        self.assertTrue(run['name'].startswith('migopy:run:'))
+        self.assertEqual(run['docs'], 100)
+        self.assertEqual(run['pending'], 1)
+        self.assertFalse(run['failed'])
+        self.assertEqual([migration['name'] for migration in
+                          run['migrations']], ['1_test.py'])
+        self.assertEqual(len(run['regressions']), 2)
+        messages = [call[0][0] for call in
+                    self.migr_mng.logger.red.call_args_list]
+        self.assertTrue(messages[0].startswith('Regression: throughput '))
+        self.assertTrue(messages[1].startswith('Regression: 1_test.py took '))
+
+    def test_it_profiles_migration(self):
+        migr_mod = types.ModuleType('1_test')
+        migr_mod.up = lambda db: sorted(range(1000), key=lambda x: -x)
+        self.migr_mng.unregistered = mock.Mock(return_value=['1_test.py'])
+        self.migr_mng.register = mock.Mock()
+        with TestDirectory():
+            with mock.patch('migopy.load_migration', return_value=migr_mod):
+                self.migr_mng.profile('1_test.py')
+                profiles = os.listdir(self.migr_mng.PROFILE_DIRECTORY)
+                self.assertEqual(len(profiles), 1)
+                self.assertTrue(profiles[0].startswith('1_test_'))
+                self.assertTrue(profiles[0].endswith('.pstats'))
+                self.assertFalse(self.migr_mng.register.called)
+                self.assertTrue(any('<lambda>' in call[0][0] for call in
+                                    self.migr_mng.logger.white.call_args_list),
+                                "Hot functions not logged")
+
+                # when asked, registers profiled migration
+                self.migr_mng.PROFILE_REGISTER = True
+                self.migr_mng.profile('1_test.py')
+                self.migr_mng.register.assert_called_once_with(
+                    ['1_test.py'], {'execute': mock.ANY})
+
+                # when given migration is not found in unregistered
+                with self.assertRaises(migopy.MigopyException):
+                    self.migr_mng.profile('3_test.py')
+
+    def test_it_dumps_collections_of_pending_migrations_in_parallel(self):
+        migr_mods = {'1_test': types.ModuleType('1_test'),
+                     '2_test': types.ModuleType('2_test')}
+        migr_mods['1_test'].COLLECTIONS = ['notes', 'users']
+        migr_mods['2_test'].COLLECTION = 'tags'
+        self.migr_mng.MONGO_DATABASE = 'd'
+        self.migr_mng.MONGO_DUMP_GZIP = True
+        self.migr_mng.unregistered = mock.Mock(return_value=['1_test.py',
+                                                             '2_test.py'])
+        with TestDirectory() as test_dir:
+            test_dir.mkdir('mongomigrations')
+            with mock.patch('migopy.local') as local_mock, \
+                    mock.patch('migopy.load_migration',
+                               side_effect=lambda directory, migr:
+                               migr_mods[migr[:-3]]):
+                self.migr_mng.dbdump()
+                commands = sorted(call[0][0] for call in
+                                  local_mock.call_args_list)
+                self.assertEqual(len(commands), 3)
+                for command, collection in zip(commands,
+                                               ['notes', 'tags', 'users']):
+                    self.assertTrue(command.startswith('mongodump -d d -o'))
+                    self.assertTrue(command.endswith(
+                        '-c %s --gzip' % collection))
+
+                # location and size of dump are recorded
+                record = self.migr_mng.collection.insert_one.call_args[0][0]
+                self.assertTrue(record['name'].startswith('migopy:dump:'))
+                self.assertTrue(record['path'].startswith('mongodumps/'))
+                self.assertEqual(record['size'], 0)
+                self.assertEqual(record['collections'],
+                                 ['notes', 'tags', 'users'])
+
+                # when some migration doesn't declare collections, dumps all
+                local_mock.reset_mock()
+                migr_mods['2_test'] = types.ModuleType('2_test')
+                self.migr_mng.MONGO_DUMP_ARCHIVE = True
+                self.migr_mng.dbdump()
+                self.assertEqual(local_mock.call_count, 1)
+                self.assertEqual(
+                    local_mock.call_args[0][0],
+                    'mongodump -d d --archive=%s/d.archive.gz --gzip' %
+                    self.migr_mng.collection.insert_one.call_args[0][0]
+                    ['path'])
+
+                # when given specyfic migration, dumps only its collections
+                local_mock.reset_mock()
+                self.migr_mng.dbdump('1_test.py')
+                self.assertEqual(local_mock.call_count, 2)
+
+            # when some dumps fail, raise exception naming their collections
+            migr_mods['2_test'].COLLECTION = 'tags'
+            with mock.patch('migopy.local', side_effect=lambda command:
+                            not command.endswith('-c tags --gzip')), \
+                    mock.patch('migopy.load_migration',
+                               side_effect=lambda directory, migr:
+                               migr_mods[migr[:-3]]):
+                with self.assertRaises(migopy.MigopyException) as cm:
+                    self.migr_mng.dbdump()
+                self.assertEqual(str(cm.exception),
+                                 'Mongo dump of collections tags failed')
+
+        # failed command is reported by result, not by SystemExit
+        self.assertTrue(migopy.local('exit 0'))
+        self.assertFalse(migopy.local('exit 3'))
+
+    def test_it_snapshots_collections_before_migration(self):
+        migr_mod = types.ModuleType('1_test')
+        migr_mod.COLLECTIONS = ['notes']
+        migr_mod.up = mock.Mock()
+        self.migr_mng.db = mock.MagicMock()
+        self.migr_mng.db.__getitem__.side_effect = \
+            collections.defaultdict(mock.MagicMock).__getitem__
+        notes = self.migr_mng.db['notes']
+        notes.index_information.return_value = {
+            '_id_': {'key': [('_id', 1)]},
+            'title_1': {'key': [('title', 1)], 'unique': True, 'v': 1}}
+        self.migr_mng.DO_MONGO_SNAPSHOT = True
+        self.migr_mng.snapshots = mock.Mock(return_value=[])
+        self.migr_mng.execute_migration('1_test.py', migr_mod)
+        pipeline = notes.aggregate.call_args[0][0]
+        backup = pipeline[1]['$out']
+        self.assertTrue(backup.startswith('migopy_snapshot.'))
+        self.assertTrue(backup.endswith('.notes'))
+        snapshot = self.migr_mng.collection.insert_one.call_args[0][0]
+        self.assertTrue(snapshot['name'].startswith('migopy:snapshot:'))
+        self.assertEqual(snapshot['migration'], '1_test.py')
+        self.assertEqual(snapshot['backups'], {'notes': backup})
+        self.assertEqual(snapshot['indexes'],
+                         {'notes': [{'key': [('title', 1)], 'unique': True,
+                                     'v': 1, 'name': 'title_1'}]})
+        migr_mod.up.assert_called_once_with(self.migr_mng.db)
+
+        # when migration doesn't declare collections, raise exception
+        with self.assertRaises(migopy.MigopyException):
+            self.migr_mng.execute_migration('2_test.py',
+                                            types.ModuleType('2_test'))
+
+        # old snapshots are dropped
+        snapshots = [dict(snapshot, name='migopy:snapshot:%d' % i,
+                          backups={'notes': 'backup%d' % i})
+                     for i in range(4, 0, -1)]
+        self.migr_mng.snapshots.return_value = snapshots
+        self.migr_mng.drop_snapshots(2)
+        self.migr_mng.db.drop_collection.assert_has_calls(
+            [mock.call('backup2'), mock.call('backup1')])
+        self.assertEqual(self.migr_mng.db.drop_collection.call_count, 2)
+
+        # the newest snapshot is restored by rename
+        self.migr_mng.restore_snapshot()
+        self.migr_mng.db['backup4'].rename.assert_called_once_with(
+            'notes', dropTarget=True)
+        notes.create_index.assert_called_once_with([('title', 1)],
+                                                   unique=True,
+                                                   name='title_1')
+        self.migr_mng.collection.delete_one.assert_called_with(
+            {'name': 'migopy:snapshot:4'})
+        query, update = \
+            self.migr_mng.collection.update_one.call_args_list[0][0]
+        self.assertEqual(query, {'name': '1_test.py'})
+        self.assertEqual(update['$set']['registered'], False)
+
+        # or snapshot given by name
+        self.migr_mng.restore_snapshot('3')
+        self.migr_mng.db['backup3'].rename.assert_called_once_with(
+            'notes', dropTarget=True)
+        with self.assertRaises(migopy.MigopyException):
+            self.migr_mng.restore_snapshot('5')
+
+    def test_it_restores_mongo_dump_in_parallel(self):
+        self.migr_mng.MONGO_DATABASE = 'd'
+        created = datetime.datetime.utcnow()
+        self.migr_mng.collection.find_one.return_value = {
+            'name': 'migopy:dump:2', 'created': created,
+            'migrations': ['2_test.py']}
+        self.migr_mng.collection.find.return_value = [{'name': '3_test.py'}]
+        with TestDirectory() as test_dir:
+            # when no dumps found, raise exception
+            with self.assertRaises(migopy.MigopyException):
+                self.migr_mng.dbrestore()
+
+            test_dir.mkdir('mongodumps/1/d')
+            test_dir.mkdir('mongodumps/2/d')
+            test_dir.touch('mongodumps/2/d/notes.bson.gz')
+            with mock.patch('migopy.local') as local_mock:
+                self.migr_mng.dbrestore()
+                local_mock.assert_called_once_with(
+                    'mongorestore -d d --dir=mongodumps/2/d --gzip --drop '
+                    '--numParallelCollections=4 '
+                    '--numInsertionWorkersPerCollection=4')
+                self.migr_mng.collection.find_one.assert_called_once_with(
+                    {'name': 'migopy:dump:2'})
+                self.assertEqual(
+                    self.migr_mng.collection.find.call_args[0][0],
+                    {'execute.finished': {'$gt': created}})
+
+                # migrations applied after dump are unregistered at once
+                self.migr_mng.collection.update_many.assert_called_once_with(
+                    {'name': {'$in': ['2_test.py', '3_test.py']}},
+                    {'$set': {'registered': False},
+                     '$unset': {'checkpoint': '', 'processed': ''}})
+
+                # when given dump of archives, restores them in parallel
+                local_mock.reset_mock()
+                test_dir.touch('mongodumps/1/notes.archive.gz')
+                test_dir.touch('mongodumps/1/users.archive')
+                self.migr_mng.dbrestore('1')
+                self.assertEqual(
+                    sorted(call[0][0].split(' --drop')[0]
+                           for call in local_mock.call_args_list),
+                    ['mongorestore --archive=mongodumps/1/notes.archive.gz '
+                     '--gzip',
+                     'mongorestore --archive=mongodumps/1/users.archive'])
+
+                # when given dump not found, raise exception
+                with self.assertRaises(migopy.MigopyException):
+                    self.migr_mng.dbrestore('3')
+
+            # when restore fails, raise exception, migrations stay registered
+            self.migr_mng.collection.update_many.reset_mock()
+            with mock.patch('migopy.local', return_value=False):
+                with self.assertRaises(migopy.MigopyException) as cm:
+                    self.migr_mng.dbrestore('2')
+            self.assertEqual(str(cm.exception),
+                             'Mongo restore of mongodumps/2 failed (1 of 1 '
+                             'mongorestore commands)')
+            self.assertFalse(self.migr_mng.collection.update_many.called)